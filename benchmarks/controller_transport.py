@@ -0,0 +1,63 @@
+#!/bin/python
+# Measures how many frames per second the controller server can serve with
+# each CONTROLLER_TRANSPORT and CONTROLLER_WIRE_FORMAT, using ControllerClient
+# in place of the emulator.
+#
+# Usage: python benchmarks/controller_transport.py [steps] [frame_skip]
+import sys
+import threading
+import time
+
+from gym_mupen64plus.envs.controller_client import ControllerClient
+from gym_mupen64plus.envs.mupen64plus_env import \
+    CONTENT_TYPES, CONTROLLER_TRANSPORTS, ControllerHTTPServer, ControllerState, ControllerTCPServer
+
+
+def poll_until_shutdown(client):
+    status = 200
+    while status == 200:
+        status, _ = client.poll()
+    client.close()
+
+
+def benchmark(transport, wire_format, steps, frame_skip):
+    if transport == 'tcp':
+        server = ControllerTCPServer(('localhost', 0), control_timeout=5, frame_skip=frame_skip,
+                                     wire_format=wire_format)
+    else:
+        server = ControllerHTTPServer(('localhost', 0), control_timeout=5, frame_skip=frame_skip,
+                                      keep_alive=transport == 'http-keepalive',
+                                      wire_format=wire_format)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    client = ControllerClient(server.server_address[1], transport=transport, wire_format=wire_format)
+    client_thread = threading.Thread(target=poll_until_shutdown, args=[client])
+    client_thread.daemon = True
+    client_thread.start()
+
+    controls = ControllerState(ControllerState.A_BUTTON)
+    start = time.time()
+    for _ in range(steps):
+        server.send_controls(controls)
+    elapsed = time.time() - start
+
+    # Release the client's final (blocked) poll and shut down
+    server.running = False
+    server.controls_updated.set()
+    client_thread.join()
+    server.shutdown()
+
+    return steps * frame_skip / elapsed
+
+
+if __name__ == '__main__':
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    frame_skip = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print('%d steps, frame_skip %d' % (steps, frame_skip))
+    for transport in CONTROLLER_TRANSPORTS:
+        for wire_format in sorted(CONTENT_TYPES):
+            print('%-15s %-7s %10.0f frames/sec' % (transport, wire_format,
+                                                    benchmark(transport, wire_format, steps, frame_skip)))
@@ -0,0 +1,148 @@
+#!/bin/python
+# Measures the accuracy and speed of the Smash DamageParser on the bundled
+# screenshots (Smash/screenshots/p<player>_health_<damage>.png).
+#
+# Accuracy is broken down as in damage_parser.main(), both for GetDamage()
+# and for GetDamages() parsing both players at once (as SmashEnv does).
+# Latency is that of parsing a screenshot from scratch: change detection and
+# the outline cache are disabled while timing. The results can be written as
+# JSON, and the exit status is 1 if either accuracy is below --min-accuracy,
+# so this can be used as a regression check when changing the parser.
+#
+# Usage: python benchmarks/damage_parser.py [--repeats N] [--json results.json]
+#                                           [--min-accuracy PERCENT]
+from __future__ import division, print_function
+
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+
+import cv2
+import numpy as np
+
+from gym_mupen64plus.envs.metrics import clock
+from gym_mupen64plus.envs.Smash import damage_parser
+
+SCREENSHOT_PATTERN = re.compile(r'p(\d)_health_(\d{3})\.png$')
+
+
+def load_screenshots():
+    # Returns a list of (player_num, damage, pixels), sorted by file name
+    screenshots = []
+    screenshot_dir = os.path.join(os.path.dirname(damage_parser.__file__), 'screenshots')
+    for fname in sorted(glob.glob(os.path.join(screenshot_dir, 'p*_health_*.png'))):
+        match = SCREENSHOT_PATTERN.search(fname)
+        if match:
+            screenshots.append((int(match.group(1)), int(match.group(2)),
+                                np.asarray(cv2.imread(fname))))
+    return screenshots
+
+
+def get_damage(player_num, pixels):
+    return damage_parser.DamageParser().GetDamage(player_num, pixels)
+
+
+def get_damages(player_num, pixels):
+    # Parses both players' damage in one call, and returns player_num's
+    return damage_parser.DamageParser().GetDamages([1, 2], pixels)[player_num - 1]
+
+
+def measure_accuracy(parse, screenshots):
+    # Counts how often parse(player_num, pixels) reads each screenshot's damage
+    # (a fresh parser each call, so no screenshot is compared with the last)
+    counts = {'correct': 0, 'no_value': 0, 'incorrect_easy': 0, 'incorrect_hard': 0}
+    for player_num, expected, pixels in screenshots:
+        damage, _ = parse(player_num, pixels)
+        if damage == -1:
+            counts['no_value'] += 1
+        elif damage == expected:
+            counts['correct'] += 1
+        # If damage increases too much, or decreases to a nonzero value, this
+        # is easy to identify in gameplay.
+        elif damage > 40 + expected or (damage < expected and damage != 0):
+            counts['incorrect_easy'] += 1
+        else:
+            counts['incorrect_hard'] += 1
+    counts['total'] = len(screenshots)
+    counts['accuracy'] = 100.0 * counts['correct'] / max(len(screenshots), 1)
+    return counts
+
+
+def measure_latency(parse, screenshots, repeats):
+    # Times each parse(player_num, pixels) call; returns its statistics in milliseconds
+    timings = []
+    for _ in range(repeats):
+        for player_num, _, pixels in screenshots:
+            start = clock()
+            parse(player_num, pixels)
+            timings.append(clock() - start)
+    timings = np.array(timings) * 1e3
+    return {'calls': len(timings),
+            'mean_ms': float(timings.mean()),
+            'p50_ms': float(np.percentile(timings, 50)),
+            'p90_ms': float(np.percentile(timings, 90)),
+            'p99_ms': float(np.percentile(timings, 99)),
+            'max_ms': float(timings.max()),
+            'calls_per_sec': float(len(timings) / (timings.sum() / 1e3))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Smash DamageParser.')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='times to parse each screenshot when timing')
+    parser.add_argument('--json', help='file to write the results to, as JSON')
+    parser.add_argument('--min-accuracy', type=float, default=0.0,
+                        help='exit with status 1 if fewer than this percentage are correct')
+    args = parser.parse_args()
+
+    screenshots = load_screenshots()
+    if not screenshots:
+        print('No screenshots found')
+        return 1
+
+    uncached = damage_parser.DamageParser(detect_changes=False, cache_size=0)
+    results = {
+        'accuracy': {'GetDamage': measure_accuracy(get_damage, screenshots),
+                     'GetDamages': measure_accuracy(get_damages, screenshots)},
+        'GetDamage': measure_latency(uncached.GetDamage, screenshots, args.repeats),
+        # Both players' damage, as SmashEnv parses it every step
+        'GetDamages': measure_latency(lambda _, pixels: uncached.GetDamages([1, 2], pixels),
+                                      screenshots, args.repeats),
+    }
+
+    print('%d screenshots' % len(screenshots))
+    for name in ['GetDamage', 'GetDamages']:
+        accuracy = results['accuracy'][name]
+        t = accuracy['total'] * 0.01
+        print('%s:' % name)
+        print('  Correct values: %d, %0.2f%%' % (accuracy['correct'], accuracy['correct'] / t))
+        print('  No value returned:  %d, %0.2f%%' % (accuracy['no_value'], accuracy['no_value'] / t))
+        print('  Incorrect, but easy to account for in game: %d, %0.2f%%' % (
+            accuracy['incorrect_easy'], accuracy['incorrect_easy'] / t))
+        print('  Incorrect, harder to identify in game: %d, %0.2f%%' % (
+            accuracy['incorrect_hard'], accuracy['incorrect_hard'] / t))
+    for name in ['GetDamage', 'GetDamages']:
+        latency = results[name]
+        print('%-10s mean %.3f ms, p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms, %.0f calls/sec' % (
+            name, latency['mean_ms'], latency['p50_ms'], latency['p90_ms'], latency['p99_ms'],
+            latency['max_ms'], latency['calls_per_sec']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    status = 0
+    for name in ['GetDamage', 'GetDamages']:
+        accuracy = results['accuracy'][name]
+        if accuracy['accuracy'] < args.min_accuracy:
+            print('%s accuracy %.2f%% is below the minimum of %.2f%%' % (
+                name, accuracy['accuracy'], args.min_accuracy))
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#!/bin/python
+# Measures the env's step loop against the fake emulator
+# (gym_mupen64plus.envs.fake_emulator), so no mupen64plus, Xvfb or ROM is
+# needed:
+#
+#   handshake - steps/sec and per-step latency of the controller server's
+#               frame skip handshake alone, for each CONTROLLER_TRANSPORT
+#   env       - steps/sec and per-step latency of a whole env (capturing the
+#               fake emulator's framebuffer), with the time spent in each phase
+#   scaling   - total steps/sec of a VectorMupenEnv of 1, 2, 4... envs
+#
+# Usage: python benchmarks/env_loop.py [--steps N] [--frame-skip N] [--fps FPS]
+#                                      [--transport T] [--num-envs 1,2,4,8] [--processes]
+#                                      [--json results.json]
+from __future__ import division, print_function
+
+import argparse
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import gym_mupen64plus
+from gym_mupen64plus.envs.mupen64plus_env import \
+    CONTROLLER_TRANSPORTS, ControllerHTTPServer, ControllerState, ControllerTCPServer, Mupen64PlusEnv
+from gym_mupen64plus.envs.screen_capture import XVFB_SCREEN_FILE
+from gym_mupen64plus.envs.vector_env import SubprocVectorMupenEnv, VectorMupenEnv
+
+ACTION = ControllerState.A_BUTTON
+
+
+def fake_emulator_process(port, transport, wire_format='json', fps=0, framebuffer_path=None,
+                          width=640, height=480):
+    cmd = [sys.executable, '-m', 'gym_mupen64plus.envs.fake_emulator',
+           '--port', str(port), '--transport', transport, '--wire-format', wire_format,
+           '--fps', str(fps), '--width', str(width), '--height', str(height)]
+    if framebuffer_path is not None:
+        cmd += ['--framebuffer', framebuffer_path]
+    # Make sure the fake emulator imports this same gym_mupen64plus
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(gym_mupen64plus.__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [package_parent] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])))
+    return subprocess.Popen(cmd, env=env)
+
+
+###############################################
+class FakeEmulatorEnv(Mupen64PlusEnv):
+    """An env driving the fake emulator, with no menus and no reward."""
+
+    def __init__(self, fps=0, config_overrides=None):
+        self.fps = fps
+        overrides = dict({'ROM_NAME': 'none', 'CAPTURE_BACKEND': 'framebuffer', 'PORT_NUMBER': 0},
+                         **(config_overrides or {}))
+        super(FakeEmulatorEnv, self).__init__(config_overrides=overrides)
+
+    def _load_config(self):
+        return
+
+    def _validate_config(self):
+        return
+
+    def _start_emulator(self, rom_name, gfx_plugin, input_driver_path, res_w=640, res_h=480, res_d=3,
+                        startup_state=None):
+        # The fake emulator draws into a framebuffer file as Xvfb would
+        self.fb_dir = tempfile.mkdtemp(prefix='gym-mupen64plus-', dir=self.config['TMP_DIR'])
+        process = fake_emulator_process(self.port, self.config['CONTROLLER_TRANSPORT'],
+                                        self.config['CONTROLLER_WIRE_FORMAT'], self.fps,
+                                        os.path.join(self.fb_dir, XVFB_SCREEN_FILE), res_w, res_h)
+        return None, process
+
+    def _navigate_menu(self):
+        return
+
+    def _get_reward(self):
+        return 0.0
+
+    def _evaluate_end_state(self):
+        return False
+
+    def _reset(self):
+        return super(FakeEmulatorEnv, self)._reset()
+
+
+def latency_stats(timings, steps_per_call=1):
+    timings = np.array(timings) * 1e3
+    return {'steps_per_sec': float(steps_per_call * len(timings) / (timings.sum() / 1e3)),
+            'mean_ms': float(timings.mean()),
+            'p50_ms': float(np.percentile(timings, 50)),
+            'p90_ms': float(np.percentile(timings, 90)),
+            'p99_ms': float(np.percentile(timings, 99))}
+
+
+def benchmark_handshake(transport, steps, frame_skip, fps):
+    if transport == 'tcp':
+        server = ControllerTCPServer(('localhost', 0), control_timeout=5, frame_skip=frame_skip)
+    else:
+        server = ControllerHTTPServer(('localhost', 0), control_timeout=5, frame_skip=frame_skip,
+                                      keep_alive=transport == 'http-keepalive')
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    emulator = fake_emulator_process(server.server_address[1], transport, fps=fps)
+    try:
+        controls = ControllerState(ACTION)
+        server.send_controls(controls) # Wait for the emulator to connect
+        timings = []
+        for _ in range(steps):
+            start = time.time()
+            server.send_controls(controls)
+            timings.append(time.time() - start)
+    finally:
+        server.shutdown()
+        emulator.wait()
+    return latency_stats(timings)
+
+
+def benchmark_env(config_overrides, steps, fps):
+    env = FakeEmulatorEnv(fps=fps, config_overrides=config_overrides)
+    try:
+        env.reset()
+        timings = []
+        for _ in range(steps):
+            start = time.time()
+            env.step(ACTION)
+            timings.append(time.time() - start)
+        results = latency_stats(timings)
+        results['phases_ms'] = dict((name, stats['mean'] * 1e3)
+                                    for name, stats in env.get_metrics()['histograms'].items())
+    finally:
+        env.close()
+    return results
+
+
+def benchmark_scaling(config_overrides, steps, fps, num_envs, use_processes):
+    env_fns = [functools.partial(FakeEmulatorEnv, fps=fps, config_overrides=config_overrides)] * num_envs
+    envs = SubprocVectorMupenEnv(env_fns) if use_processes else VectorMupenEnv(env_fns)
+    try:
+        envs.reset()
+        actions = [ACTION] * num_envs
+        timings = []
+        for _ in range(steps):
+            start = time.time()
+            envs.step(actions)
+            timings.append(time.time() - start)
+    finally:
+        envs.close()
+    return latency_stats(timings, steps_per_call=num_envs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the env against the fake emulator.')
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--frame-skip', type=int, default=5)
+    parser.add_argument('--fps', type=float, default=0,
+                        help="the fake emulator's frame rate; 0 for as fast as possible")
+    parser.add_argument('--transport', default='http', choices=CONTROLLER_TRANSPORTS,
+                        help='the CONTROLLER_TRANSPORT for the env and scaling benchmarks')
+    parser.add_argument('--num-envs', default='1,2,4',
+                        help='comma separated numbers of envs for the scaling benchmark')
+    parser.add_argument('--processes', action='store_true',
+                        help='use SubprocVectorMupenEnv for the scaling benchmark')
+    parser.add_argument('--json', help='file to write the results to, as JSON')
+    args = parser.parse_args()
+
+    config_overrides = {'FRAME_SKIP': args.frame_skip, 'CONTROLLER_TRANSPORT': args.transport}
+    results = {'handshake': {}, 'scaling': {}}
+
+    print('%d steps, frame_skip %d' % (args.steps, args.frame_skip))
+    row = '%-22s %8.0f steps/sec  mean %7.3f ms  p50 %7.3f ms  p90 %7.3f ms  p99 %7.3f ms'
+    for transport in CONTROLLER_TRANSPORTS:
+        stats = results['handshake'][transport] = \
+            benchmark_handshake(transport, args.steps, args.frame_skip, args.fps)
+        print(row % (('handshake ' + transport,) + tuple(
+            stats[key] for key in ('steps_per_sec', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms'))))
+
+    stats = results['env'] = benchmark_env(config_overrides, args.steps, args.fps)
+    print(row % (('env ' + args.transport,) + tuple(
+        stats[key] for key in ('steps_per_sec', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms'))))
+    for name, mean_ms in sorted(stats['phases_ms'].items()):
+        print('    %-32s mean %7.3f ms' % (name, mean_ms))
+
+    for num_envs in [int(n) for n in args.num_envs.split(',')]:
+        stats = results['scaling'][num_envs] = \
+            benchmark_scaling(config_overrides, args.steps, args.fps, num_envs, args.processes)
+        print(row % (('%d envs' % num_envs,) + tuple(
+            stats[key] for key in ('steps_per_sec', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms'))))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/bin/python
+# Checks the MarioKart checkpoint rewards on the bundled HUD progress
+# screenshot (MarioKart64/screenshots/hud_progress.png), without an emulator.
+#
+# Each case starts from a last known checkpoint and checks the reward for
+# then observing the screenshot: the first detection after a reset is only
+# rewarded for the current checkpoint, a step from a nearby checkpoint for
+# every checkpoint crossed, and an implausibly large jump for at most
+# CHECKPOINT_SEARCH_WINDOW checkpoints. The exit status is 1 if any case
+# fails, so this can be used as a regression check when changing the rewards.
+#
+# Usage: python benchmarks/mario_kart_checkpoints.py
+from __future__ import division, print_function
+
+import os
+import sys
+
+import cv2
+import numpy as np
+
+from gym_mupen64plus.envs.MarioKart64 import mario_kart_env
+from gym_mupen64plus.envs.MarioKart64.mario_kart_env import MarioKartEnv
+
+
+###############################################
+class ScreenshotMarioKartEnv(MarioKartEnv):
+    """A MarioKartEnv that reads the HUD from a screenshot rather than the emulator."""
+
+    ENABLE_CHECKPOINTS = True
+
+    def __init__(self, pixels):
+        self.screen_scale = (1.0, 1.0)
+        self._init_checkpoints()
+        self.pixel_array = pixels
+        self.episode_over = False
+        self.step_count = 0
+
+    def reset_checkpoints(self, last_known_ckpt=-1):
+        # The checkpoint state _reset() starts an episode with, then a step up to last_known_ckpt
+        self.lap = self._get_lap()
+        self.step_count_at_lap = 0
+        self.last_known_lap = self.lap
+        self._checkpoint_tracker = np.zeros((3, len(self.CHECKPOINT_LOCATIONS)), dtype=bool)
+        self._checkpoint_tracker[self.lap - 1][:last_known_ckpt + 1] = True
+        self.last_known_ckpt = last_known_ckpt
+
+    def _close(self):
+        return
+
+
+def load_screenshot(name):
+    path = os.path.join(os.path.dirname(mario_kart_env.__file__), 'screenshots', name)
+    # The env's pixels are RGB
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+
+
+def main():
+    env = ScreenshotMarioKartEnv(load_screenshot('hud_progress.png'))
+    env.reset_checkpoints()
+    checkpoint = env._get_current_checkpoint()
+    window = env.CHECKPOINT_SEARCH_WINDOW
+    print('hud_progress.png: lap %d, checkpoint %d of %d' % (env.lap, checkpoint, len(env.CHECKPOINT_LOCATIONS)))
+
+    # (description, last known checkpoint, expected checkpoints rewarded)
+    cases = [('first detection after a reset', -1, 1),
+             ('one step from %d checkpoints back' % 5, checkpoint - 5, 5),
+             ('one step from %d checkpoints back' % window, checkpoint - window, window),
+             ('implausible jump from checkpoint 0', 0, window)]
+    failures = 0
+    for description, last_known_ckpt, expected in cases:
+        env.reset_checkpoints(last_known_ckpt)
+        reward = env._get_reward()
+        ok = reward == expected * env.CHECKPOINT_REWARD
+        failures += not ok
+        print('%-40s reward %6.2f, expected %6.2f  %s' % (
+            description, reward, expected * env.CHECKPOINT_REWARD, 'ok' if ok else 'FAILED'))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
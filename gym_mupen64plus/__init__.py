@@ -1,5 +1,6 @@
 import logging
 from gym_mupen64plus.envs.MarioKart64.mario_kart_env import MarioKartEnv
 from gym_mupen64plus.envs.Smash.smash_env import SmashEnv
+from gym_mupen64plus.wrappers import FrameStack, SplitStepTimeLimit
 
 logger = logging.getLogger(__name__)
@@ -31,14 +31,15 @@ class MarioKartDiscreteEnv(MarioKartEnv):
 
     ENABLE_CHECKPOINTS = True
 
-    def __init__(self, character='mario', course='LuigiRaceway'):
-        super(MarioKartDiscreteEnv, self).__init__(character=character, course=course)
+    def __init__(self, character='mario', course='LuigiRaceway', config_overrides=None):
+        super(MarioKartDiscreteEnv, self).__init__(character=character, course=course,
+                                                   config_overrides=config_overrides)
 
         # This needs to happen after the parent class init to effectively override the action space
         self.action_space = DiscreteActions.get_action_space()
 
-    def _step(self, action):
+    def _get_controls(self, action):
         # Interpret the action choice and get the actual controller state for this step
         controls = DiscreteActions.get_controls_from_action(action)
 
-        return super(MarioKartDiscreteEnv, self)._step(controls)
+        return super(MarioKartDiscreteEnv, self)._get_controls(controls)
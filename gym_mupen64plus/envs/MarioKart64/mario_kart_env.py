@@ -13,8 +13,9 @@ import numpy as np
 class MarioKartEnv(Mupen64PlusEnv):
     __metaclass__ = abc.ABCMeta
 
-    # Indicates the color value of the pixel at point (203, 51)
+    # Indicates the color value of the pixel at point END_RACE_PIXEL
     # This is where the lap number is present in the default HUD
+    END_RACE_PIXEL = (203, 51)
     END_RACE_PIXEL_COLORS = {"mupen64plus-video-rice.so"       : ( 66,  49,  66),
                              "mupen64plus-video-glide64mk2.so" : (214, 148, 214),
                              "mupen64plus-video-glide64.so"    : (157, 112, 158)}
@@ -39,12 +40,19 @@ class MarioKartEnv(Mupen64PlusEnv):
 
     ENABLE_CHECKPOINTS = False
 
-    def __init__(self, character='mario', course='LuigiRaceway'):
+    # How many checkpoints either side of the last known checkpoint to search
+    # for the current one, before falling back to scanning the whole HUD border
+    CHECKPOINT_SEARCH_WINDOW = 32
+
+    def __init__(self, character='mario', course='LuigiRaceway', config_overrides=None):
         self._set_character(character)
         self._set_course(course)
-        super(MarioKartEnv, self).__init__()
+        super(MarioKartEnv, self).__init__(config_overrides=config_overrides)
 
         self.end_race_pixel_color = self.END_RACE_PIXEL_COLORS[self.config["GFX_PLUGIN"]]
+        self.end_race_pixel = self._scale_point(*self.END_RACE_PIXEL)
+
+        self._init_checkpoints()
         
         self.action_space = spaces.MultiDiscrete([[-80, 80],  # Joystick X-axis
                                                   [-80, 80],  # Joystick Y-axis
@@ -52,6 +60,21 @@ class MarioKartEnv(Mupen64PlusEnv):
                                                   [  0,  1],  # B Button
                                                   [  0,  1]]) # RB Button
 
+    def _init_checkpoints(self):
+        # Needs only screen_scale, so the checkpoints can be evaluated on screenshots
+        # (see benchmarks/mario_kart_checkpoints.py)
+        self.CHECKPOINT_LOCATIONS = [[self._scale_point(*point) for point in points]
+                                     for points in self._generate_checkpoints(64, 36, 584, 444)]
+        # The same locations as (checkpoints x 4) arrays of pixel coordinates, to
+        # look up all the checkpoints' pixels at once
+        checkpoint_points = np.array(self.CHECKPOINT_LOCATIONS)
+        self._checkpoint_xs = checkpoint_points[:, :, 0]
+        self._checkpoint_ys = checkpoint_points[:, :, 1]
+        # Lookup table from (packed) HUD progress color to lap value
+        colors = sorted(self.HUD_PROGRESS_COLOR_VALUES)
+        self._progress_color_codes = np.array([(r << 16) | (g << 8) | b for r, g, b in colors])
+        self._progress_color_laps = np.array([self.HUD_PROGRESS_COLOR_VALUES[color] for color in colors])
+
     def _load_config(self):
         self.config.update(yaml.safe_load(open(os.path.join(os.path.dirname(inspect.stack()[0][1]), "mario_kart_config.yml"))))
         
@@ -61,11 +84,14 @@ class MarioKartEnv(Mupen64PlusEnv):
         if gfx_plugin not in self.END_RACE_PIXEL_COLORS:
             raise AssertionError("Video Plugin '" + gfx_plugin + "' not currently supported by MarioKart environment")
 
-    def _step(self, action):
+    def _menu_signature(self):
+        return (self.PLAYER_ROW, self.PLAYER_COL, self.MAP_SERIES, self.MAP_CHOICE)
+
+    def _get_controls(self, action):
         # Interpret the action choice and get the actual controller state for this step
         controls = action + [  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0]
 
-        return super(MarioKartEnv, self)._step(controls)
+        return super(MarioKartEnv, self)._get_controls(controls)
 
     def _reset_after_race(self):
         self._wait(count=275, wait_for='times screen')
@@ -90,16 +116,18 @@ class MarioKartEnv(Mupen64PlusEnv):
         self.step_count_at_lap = 0
         self.last_known_lap = -1
 
-        self.CHECKPOINT_LOCATIONS = list(self._generate_checkpoints(64, 36, 584, 444)) 
         if self.ENABLE_CHECKPOINTS:
-            self._checkpoint_tracker = [[False for i in range(len(self.CHECKPOINT_LOCATIONS))] for j in range(3)]
+            self._checkpoint_tracker = np.zeros((3, len(self.CHECKPOINT_LOCATIONS)), dtype=bool)
             self.last_known_ckpt = -1
         
         # Nothing to do on the first call to reset()
         if self.reset_count > 0:
             # Make sure we don't skip frames while navigating the menus
             with self.controller_server.frame_skip_disabled():
-                if self.episode_over:
+                if self.config['USE_SAVESTATES']:
+                    self._load_state()
+                    self.episode_over = False
+                elif self.episode_over:
                     self._reset_after_race()
                     self.episode_over = False
                 else:
@@ -136,8 +164,7 @@ class MarioKartEnv(Mupen64PlusEnv):
                 #       Need to investigate further. Might need to restore check for sequential checkpoints
 
                 #cprint(str(self.step_count) + ': CHECKPOINT achieved!', 'green')
-                self._checkpoint_tracker[self.lap - 1][cur_ckpt] = True
-                reward_to_return = self.CHECKPOINT_REWARD # TODO: This should reward per progress made. It seems as though currently, by going too fast, you could end up skipping over some progress rewards, which would encourage driving around a bit to achieve those rewards. Should reward whatever progress was achieved during the step (perhaps multiple 'checkpoints')
+                reward_to_return = self._get_checkpoint_reward(cur_ckpt)
 
             elif (self.ENABLE_CHECKPOINTS and ( cur_lap < self.last_known_lap or
                                                cur_ckpt < self.last_known_ckpt)):
@@ -154,6 +181,21 @@ class MarioKartEnv(Mupen64PlusEnv):
         self.last_known_lap = cur_lap
         return reward_to_return
 
+    def _get_checkpoint_reward(self, cur_ckpt):
+        # Reward every checkpoint achieved since the last step; going fast can cover several per step.
+        # A step can't plausibly cover more than CHECKPOINT_SEARCH_WINDOW checkpoints, so a bigger
+        # jump (a misread HUD) is only credited that many. When the last checkpoint isn't known
+        # (the first detection after a reset, or after the icon hid the end of the bar), the full
+        # scan may report the whole lap achieved, so only the current checkpoint is rewarded.
+        if self.last_known_ckpt < 0 or self.last_known_ckpt >= cur_ckpt:
+            first_ckpt = cur_ckpt
+        else:
+            first_ckpt = max(self.last_known_ckpt + 1, cur_ckpt - self.CHECKPOINT_SEARCH_WINDOW + 1)
+        achieved = self._checkpoint_tracker[self.lap - 1][first_ckpt:cur_ckpt + 1]
+        reward = self.CHECKPOINT_REWARD * np.count_nonzero(~achieved)
+        achieved[:] = True
+        return reward
+
     def _get_lap(self):
         # The first checkpoint is the upper left corner. It's value should tell us the lap.
         ckpt_val = self._evaluate_checkpoint(self.CHECKPOINT_LOCATIONS[0])
@@ -194,11 +236,14 @@ class MarioKartEnv(Mupen64PlusEnv):
             yield [(x_val, y_val), (x_val + 1, y_val), (x_val, y_val + 1), (x_val + 1, y_val + 1)]
 
     def _get_current_checkpoint(self):
-        checkpoint_values = [self._evaluate_checkpoint(points)
-                             for points in self.CHECKPOINT_LOCATIONS]
+        checkpoint = self._find_checkpoint_near(self.last_known_ckpt)
+        if checkpoint is not None:
+            return checkpoint
+
+        checkpoint_values = self._evaluate_checkpoints()
 
         # Check if we have achieved any checkpoints
-        if any(val > -1 for val in checkpoint_values):
+        if (checkpoint_values > -1).any():
             
             # argmin tells us the first index with the lowest value
             index_of_lowest_val = np.argmin(checkpoint_values)
@@ -229,6 +274,36 @@ class MarioKartEnv(Mupen64PlusEnv):
     def all_equal(self, some_list):
         return some_list.count(some_list[0]) == len(some_list)
 
+    def _find_checkpoint_near(self, last_checkpoint):
+        # Progress only moves a few checkpoints per step, so look for the end of the
+        # progress bar near where it was last time. In the window, the checkpoints
+        # must show the achieved color up to the current checkpoint, followed by an
+        # unknown value (-1; normally the character icon, which sits at the end of
+        # the bar), which is what the full scan's argmin would find. Otherwise
+        # returns None, and the whole border is scanned instead.
+        if last_checkpoint < 0:
+            return None
+        start = max(last_checkpoint - self.CHECKPOINT_SEARCH_WINDOW, 0)
+        stop = min(last_checkpoint + self.CHECKPOINT_SEARCH_WINDOW + 2, len(self.CHECKPOINT_LOCATIONS))
+        values = self._evaluate_checkpoints(start, stop)
+
+        boundary = np.argmin(values == values[0])
+        if values[0] == -1 or values[boundary] != -1:
+            return None
+        return start + boundary - 1
+
+    def _evaluate_checkpoints(self, start=0, stop=None):
+        # Equivalent to _evaluate_checkpoint() for each of the checkpoints [start, stop), in one pass
+        pixels = self.pixel_array[self._checkpoint_ys[start:stop], self._checkpoint_xs[start:stop]].astype(np.int32)
+        codes = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+
+        first_codes = codes[:, 0]
+        lut_index = np.minimum(np.searchsorted(self._progress_color_codes, first_codes),
+                               len(self._progress_color_codes) - 1)
+        valid = (self._progress_color_codes[lut_index] == first_codes) & \
+                (codes == first_codes[:, np.newaxis]).all(axis=1)
+        return np.where(valid, self._progress_color_laps[lut_index], -1)
+
     def _evaluate_checkpoint(self, checkpoint_points):
         checkpoint_pixels = [IMAGE_HELPER.GetPixelColor(self.pixel_array, point[0], point[1])
                              for point in checkpoint_points]
@@ -247,7 +322,7 @@ class MarioKartEnv(Mupen64PlusEnv):
 
     def _evaluate_end_state(self):
         #cprint('Evaluate End State called!','yellow')
-        return self.end_race_pixel_color == IMAGE_HELPER.GetPixelColor(self.pixel_array, 203, 51)
+        return self.end_race_pixel_color == IMAGE_HELPER.GetPixelColor(self.pixel_array, *self.end_race_pixel)
 
     def _navigate_menu(self):
         self._wait(count=10, wait_for='Nintendo screen')
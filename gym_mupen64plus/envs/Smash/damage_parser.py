@@ -1,9 +1,13 @@
 import numpy as np
 import cv2
 import os.path
+from collections import OrderedDict
 
 
 _HEIGHT = 38
+_Y_PIXEL_RANGE = (400, 400 + _HEIGHT)  # Shared by every player's damage section.
+# The x range of each player's damage section at 640x480.
+_X_PIXEL_RANGES = {1: (45, 178), 2: (185, 318)}
 
 SUCCESS = 0
 PERCENT_UNDETECTED = 1  # Couldn't detect the % character.
@@ -35,127 +39,272 @@ def _initialize_character_pixels_from_files():
 
 PERCENT_PIXELS, DIGIT_TO_PIXELS = _initialize_character_pixels_from_files()
 
+# All the character outlines side by side, so they can be matched against the
+# damage outline at once. Template 0 is the %, and template 1 + d is digit d.
+_TEMPLATES = [PERCENT_PIXELS] + DIGIT_TO_PIXELS
+_PERCENT_TEMPLATE = 0
+_DIGIT_TEMPLATES = np.arange(1, 11)
+_TEMPLATE_WIDTHS = np.array([len(pixels[0]) for pixels in _TEMPLATES])
+_TEMPLATE_COUNTS = np.array([np.count_nonzero(pixels) for pixels in _TEMPLATES])
+# Each template padded with white columns to the widest one:
+_TEMPLATE_STACK = np.zeros((len(_TEMPLATES), _HEIGHT, _TEMPLATE_WIDTHS.max()))
+for _i, _pixels in enumerate(_TEMPLATES):
+    _TEMPLATE_STACK[_i, :, :_TEMPLATE_WIDTHS[_i]] = _pixels
+_TEMPLATE_COLUMNS = np.arange(_TEMPLATE_WIDTHS.max())
+# ...and as one (template column x row) matrix:
+_TEMPLATE_MATRIX = _TEMPLATE_STACK.transpose(0, 2, 1).reshape(-1, _HEIGHT)
+
+# Number of positions searched for each digit, to the left of the previous character.
+_DIGIT_SEARCH_OFFSETS = np.arange(4)
+
 class DamageParser(object):
-    def __init__(self):
-        # Records the color of the inside of 0 when damage is 0%.
-        self._zero_pixel = None
-
-    # Returns the pixel index and score of the best match of digit_pixels in
-    # damage_pixels. We start looking with the leftmost pixels of digit_pixels
-    # at start_pixel, and stop when those leftmost pixels reach stop_pixel.
-    # If it doesn't find a match, returns a negative pixel index.
-    def _find_match(self, digit_pixels, damage_pixels, start_pixel,
-                    stop_pixel):
-        mask_len = len(digit_pixels[0])
-        inc_or_dec = 1 if stop_pixel > start_pixel else -1
-        best_score = -1e9
-        best_idx = -1
-        for i in range(start_pixel, stop_pixel, inc_or_dec):
-            if i < 0 or i + mask_len > len(damage_pixels[0]):
-                continue
-            cut_pixels = damage_pixels[:, i:i + mask_len]
-            intersection = np.sum(np.logical_and(digit_pixels, cut_pixels))
-            union = np.sum(np.logical_or(digit_pixels, cut_pixels))
-
-            score = intersection / float(union)  # Jaccard overlap of the black areas.
-            if (score > 0.35 and score > best_score):
-                best_score = score
-                best_idx = i
-        return (best_idx, best_score)
+    # screen_scale is the (x, y) scale of the screen relative to the native
+    # 640x480 resolution the damage locations and outlines are defined at.
+    # With detect_changes, a player's damage is only parsed again when the
+    # pixels of their damage section have changed since the last call.
+    # Up to cache_size damage outlines (a fingerprint of their pixels) are
+    # cached with the characters read from them; 0 disables the cache.
+    def __init__(self, screen_scale=(1.0, 1.0), detect_changes=True, cache_size=1024):
+        # Records the color of the inside of 0 when damage is 0%, per player.
+        self._zero_pixels = {}
+        self._screen_scale = screen_scale
+        self._detect_changes = detect_changes
+        # The damage section pixels and result of the last parse, per player.
+        self._last_sections = {}
+        self._last_results = {}
+        # Maps (player_num, outline fingerprint) to the characters read from the
+        # outline, least recently used first.
+        self._cache_size = cache_size
+        self._outline_cache = OrderedDict()
+        # unchanged: calls answered from the last result, parsed: calls parsed.
+        # cache_*: lookups of parsed outlines in the outline cache.
+        self.stats = {'unchanged': 0, 'parsed': 0,
+                      'cache_hits': 0, 'cache_misses': 0, 'cache_evictions': 0}
+
+    # Counts, for each template, template column and damage column, the black
+    # pixels the template column has in common with the damage column. The
+    # overlap of a template placed at any offset is then a sum of these.
+    def _get_overlaps(self, damage_pixels):
+        # (Pixel counts are exact in floating point, so the scores match counting them directly.)
+        overlaps = np.dot(_TEMPLATE_MATRIX, damage_pixels.astype(np.float64))
+        overlaps = overlaps.reshape(len(_TEMPLATES), len(_TEMPLATE_COLUMNS), -1)
+        # Running totals of black pixels per column, for the black pixels under any window
+        damage_counts = np.concatenate(([0], np.cumsum(np.count_nonzero(damage_pixels, axis=0))))
+        return (overlaps, damage_counts)
+
+    # Scores placing each of the templates at each of its offsets (rows of
+    # offsets, in search order) on the damage pixels the overlaps were computed
+    # for. Returns the template, pixel index and score of the best match: the
+    # first, in search order, with the highest Jaccard overlap of the black
+    # areas over 0.35. If there is no match, returns a negative pixel index.
+    def _find_match(self, overlaps, templates, offsets):
+        overlaps, damage_counts = overlaps
+        x_len = len(damage_counts) - 1
+        widths = _TEMPLATE_WIDTHS[templates][:, np.newaxis]
+        valid = (offsets >= 0) & (offsets + widths <= x_len)
+        offsets = np.where(valid, offsets, 0)
+
+        # Sum each template column's overlap with the damage column it lands on.
+        # (Padding columns overlap nothing, wherever they land.)
+        columns = np.minimum(offsets[:, :, np.newaxis] + _TEMPLATE_COLUMNS, x_len - 1)
+        intersection = overlaps[templates[:, np.newaxis, np.newaxis],
+                                _TEMPLATE_COLUMNS, columns].sum(axis=2)
+        union = (_TEMPLATE_COUNTS[templates][:, np.newaxis] +
+                 damage_counts[np.minimum(offsets + widths, x_len)] -
+                 damage_counts[offsets] - intersection)
+
+        scores = intersection / union
+        scores[~valid | (scores <= 0.35)] = -1e9
+        best = np.argmax(scores)
+        template_idx, offset_idx = np.unravel_index(best, scores.shape)
+        if scores[template_idx, offset_idx] == -1e9:
+            return (-1, -1, -1e9)
+        return (templates[template_idx], offsets[template_idx, offset_idx],
+                scores[template_idx, offset_idx])
 
     # Slice the pixels to contain only the section which contains the
     # damage.
     def _get_damage_screen_section(self, player_num, pixels):
-        x_pixel_range = (45, 178) if player_num == 1 else (185, 318)
-        y_pixel_range = (400, 400 + _HEIGHT)
-        return pixels[y_pixel_range[0]:y_pixel_range[1],
-                      x_pixel_range[0]:x_pixel_range[1], :]
+        return self._get_screen_strip(_X_PIXEL_RANGES[player_num], pixels)
+
+    # The strip of the damage rows between the given (native) x range, resized
+    # back to the native size at other resolutions, so the outlines (and tuned
+    # offsets) still apply.
+    def _get_screen_strip(self, x_pixel_range, pixels):
+        strip = self._slice_screen_strip(x_pixel_range, pixels)
+        if self._screen_scale == (1.0, 1.0):
+            return strip
+        return cv2.resize(strip, (x_pixel_range[1] - x_pixel_range[0], _HEIGHT),
+                          interpolation=cv2.INTER_CUBIC)
+
+    # The strip of the damage rows (at the screen's actual resolution) between
+    # the given (native) x range.
+    def _slice_screen_strip(self, x_pixel_range, pixels):
+        scale_x, scale_y = self._screen_scale
+        return pixels[int(_Y_PIXEL_RANGE[0] * scale_y):int(_Y_PIXEL_RANGE[1] * scale_y),
+                      int(x_pixel_range[0] * scale_x):int(x_pixel_range[1] * scale_x), :]
 
     # Uses OpenCV to get the outline of the damage. Returned as a boolean array:
     # True if the image is black, False if it is white.
     def _get_damage_outline_from_pixels(self, player_num, pixels):
-        assert player_num == 1 or player_num == 2
-        pixels = self._get_damage_screen_section(player_num, pixels)
-        x_len = len(pixels[0])
+        return self._get_damage_outlines_from_pixels([player_num], pixels)[player_num]
+
+    # Gets the damage outlines of several players at once. Their sections share
+    # the same rows, so the strip spanning all of them is outlined in one pass
+    # and then split up. Returns a dict from player number to outline.
+    def _get_damage_outlines_from_pixels(self, player_nums, pixels):
+        x_ranges = [_X_PIXEL_RANGES[player_num] for player_num in player_nums]
+        strip_x = min(x_range[0] for x_range in x_ranges)
+        pixels = self._get_screen_strip(
+            (strip_x, max(x_range[1] for x_range in x_ranges)), pixels)
         assert len(pixels) == _HEIGHT
         # Use OpenCV to find the outlines of the numbers in black and white.
         bw = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
         thresh = cv2.adaptiveThreshold(bw, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
                                        cv2.THRESH_BINARY, 3, 2)
         dilated = cv2.dilate(thresh, np.ones((2,2), np.uint8), iterations = 1)
-        return dilated == 0  # True where the pixels are black, False where white.
+        outline = dilated == 0  # True where the pixels are black, False where white.
+        return dict((player_num, outline[:, x_range[0] - strip_x:x_range[1] - strip_x])
+                    for player_num, x_range in zip(player_nums, x_ranges))
 
     # The first time we detect a zero, record its inner pixels. Later, we
     # can determine whether a zero is a true zero or not based on whether
     # it is the correct color.
     def _set_zero_pixel(self, player_num, screen, zero_x_idx):
         pixels = self._get_damage_screen_section(player_num, screen)
-        self._zero_pixel = pixels[32][13 + zero_x_idx]
+        self._zero_pixels[player_num] = pixels[32][13 + zero_x_idx]
 
     # If the zero pixel doesn't match the first pixel we recorded, it is
     # not a true zero- we missed some digits.
     def _is_zero_reasonable(self, player_num, screen, zero_x_idx):
         pixels = self._get_damage_screen_section(player_num, screen)
         zero_pixel = pixels[32][13 + zero_x_idx]
-        if np.any(zero_pixel != self._zero_pixel):
+        if np.any(zero_pixel != self._zero_pixels[player_num]):
             return False
         return True
 
+    # Forgets the recorded zero colors (and so the results depending on them),
+    # e.g. for a new match. The cached outlines are kept.
+    def reset(self):
+        self._zero_pixels = {}
+        self._last_sections = {}
+        self._last_results = {}
+
     # Given the player number (1 and 2) and a screenshot of the game,
     # return the damage of the player. Returns a pair. The first value returned is
     # the damage if it is detected, or else -1. The second value returned is
     # an error code, one of the three above.
     def GetDamage(self, player_num, screen):
-        pixels = self._get_damage_outline_from_pixels(player_num, screen)
+        return self.GetDamages([player_num], screen)[0]
+
+    # Like GetDamage, but for several players from the same screenshot, which
+    # is cheaper than calling GetDamage for each. Returns a list of pairs, in
+    # the order of player_nums.
+    def GetDamages(self, player_nums, screen):
+        results = {}
+        changed_player_nums = []
+        for player_num in player_nums:
+            # Most frames don't change the damage; if the section is unchanged, so is the result.
+            if self._detect_changes and self._is_section_unchanged(player_num, screen):
+                self.stats['unchanged'] += 1
+                results[player_num] = self._last_results[player_num]
+            else:
+                changed_player_nums.append(player_num)
+
+        if changed_player_nums:
+            outlines = self._get_damage_outlines_from_pixels(changed_player_nums, screen)
+            for player_num in changed_player_nums:
+                results[player_num] = self._parse_damage(player_num, outlines[player_num], screen)
+                self.stats['parsed'] += 1
+                if self._detect_changes:
+                    self._last_results[player_num] = results[player_num]
+        return [results[player_num] for player_num in player_nums]
+
+    # Whether the player's damage section is the same as the last time it was
+    # parsed. If not, it is recorded for next time.
+    def _is_section_unchanged(self, player_num, screen):
+        section = self._slice_screen_strip(_X_PIXEL_RANGES[player_num], screen)
+        last_section = self._last_sections.get(player_num)
+        if last_section is not None and np.array_equal(section, last_section):
+            return True
+        if last_section is None or last_section.shape != section.shape:
+            self._last_sections[player_num] = last_section = np.empty_like(section)
+        np.copyto(last_section, section)
+        return False
+
+    def _parse_damage(self, player_num, pixels, screen):
+        if self._cache_size > 0:
+            damage, error, first_digit_x = self._read_cached_outline(player_num, pixels)
+        else:
+            damage, error, first_digit_x = self._read_outline(pixels)
+        if error != SUCCESS:
+            return (damage, error)
+        # The outline of 0 doesn't show its color, so check that separately.
+        if player_num not in self._zero_pixels and damage == 0:
+            self._set_zero_pixel(player_num, screen, first_digit_x)
+        elif (damage == 0 and
+              not self._is_zero_reasonable(player_num, screen,
+                                           first_digit_x)):
+            return (-1, ZERO_NOT_RIGHT_COLOR)
+        return (damage, SUCCESS)
+
+    # The damage only shows 0-999% in a fixed font, so the same outlines
+    # recur; look them up by their packed pixels before reading them.
+    def _read_cached_outline(self, player_num, pixels):
+        key = (player_num, np.packbits(pixels).tobytes())
+        result = self._outline_cache.pop(key, None)
+        if result is not None:
+            self.stats['cache_hits'] += 1
+        else:
+            self.stats['cache_misses'] += 1
+            result = self._read_outline(pixels)
+            if len(self._outline_cache) >= self._cache_size:
+                self._outline_cache.popitem(last=False)
+                self.stats['cache_evictions'] += 1
+        # (Re)inserted as the most recently used.
+        self._outline_cache[key] = result
+        return result
+
+    # Reads the characters from a damage outline. Returns the damage (or -1),
+    # an error code, and the x index of the last digit (or -1).
+    def _read_outline(self, pixels):
+        overlaps = self._get_overlaps(pixels)
         percent_len = len(PERCENT_PIXELS[0])
         x_len = len(pixels[1])
         # First find the %, and work left from there.
         # X range below hand tuned to properly find the % in the smallest case (1%).
         percent_match = self._find_match(
-            PERCENT_PIXELS, pixels, x_len // 2 - 9, x_len - percent_len)
-        if percent_match[0] == -1:
-            return (-1, PERCENT_UNDETECTED)
-        start_match_px = percent_match[0]
+            overlaps, np.array([_PERCENT_TEMPLATE]),
+            np.arange(x_len // 2 - 9, x_len - percent_len)[np.newaxis])
+        if percent_match[1] == -1:
+            return (-1, PERCENT_UNDETECTED, -1)
+        start_match_px = percent_match[1]
         multiplier = 1
         digits_found = 0
         first_digit_x = -1
         # Search for up to 3 digits. Look to the left of the most recently found
         # character.
         for i in range(3):  # Need to find potentially 3 digits.
-            best_digit_match = (-1, -1e9)
-            best_digit = -1
             start_idx = 1 if i == 2 else 0  # Don't search for 0 in the final digit.
-            for digit in range(start_idx, 10):
-                digit_pixels = DIGIT_TO_PIXELS[digit]
-                digit_len = len(digit_pixels[0])
-                # These have been tuned a bit to give the best possible values.
-                # We may see tiny decreases from making them too large as we have
-                # false positive digits identified, but things get really bad
-                # if they get much smaller.
-                start_search = start_match_px - digit_len
-                end_search = start_match_px - 4 - digit_len
-                digit_match = self._find_match(
-                    digit_pixels, pixels, start_search, end_search)
-                if digit_match[1] > best_digit_match[1]:
-                    best_digit_match = digit_match
-                    best_digit = digit
-                    if i == 0:
-                        first_digit_x = best_digit_match[0]
-            if best_digit_match[0] >= 0:
-                digits_found += best_digit * multiplier
-                start_match_px = best_digit_match[0]
+            templates = _DIGIT_TEMPLATES[start_idx:]
+            # These have been tuned a bit to give the best possible values.
+            # We may see tiny decreases from making them too large as we have
+            # false positive digits identified, but things get really bad
+            # if they get much smaller.
+            offsets = (start_match_px - _TEMPLATE_WIDTHS[templates][:, np.newaxis] -
+                       _DIGIT_SEARCH_OFFSETS)
+            template, digit_x, _ = self._find_match(overlaps, templates, offsets)
+            if digit_x >= 0:
+                if i == 0:
+                    first_digit_x = digit_x
+                digits_found += (template - _DIGIT_TEMPLATES[0]) * multiplier
+                start_match_px = digit_x
             elif i == 0:
-                return (-1, DIGIT_AFTER_PERCENT_UNDETECTED)
+                return (-1, DIGIT_AFTER_PERCENT_UNDETECTED, -1)
             else:
                 break
             multiplier *= 10
-        if self._zero_pixel is None and digits_found == 0:
-            self._set_zero_pixel(player_num, screen, first_digit_x)
-        elif (digits_found == 0 and
-              not self._is_zero_reasonable(player_num, screen,
-                                           first_digit_x)):
-            return (-1, ZERO_NOT_RIGHT_COLOR)
-        return (digits_found, SUCCESS)
+        return (digits_found, SUCCESS, first_digit_x)
 
 def main():  # Can be run as a test on the screenshots_below
     # Screenshots with damage identified correctly.
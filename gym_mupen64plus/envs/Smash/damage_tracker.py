@@ -14,9 +14,14 @@ _MISSING_PERCENTS_IN_ROW_THRESHOLD = 12
 # the reported damage value.
 # Note: We recommend using a frame_skip no higher than 3, or it may be
 # unreliable at detecting deaths at 0 damage.
+# A DamageParser can be shared between the trackers of several players (see
+# observe_parsed_damage); otherwise each tracker creates its own.
 class DamageTracker(object):
-    def __init__(self, frame_skip, playernum=1):
-        self._damage_parser = damage_parser.DamageParser()
+    def __init__(self, frame_skip, playernum=1, screen_scale=(1.0, 1.0),
+                 parser=None):
+        if parser is None:
+            parser = damage_parser.DamageParser(screen_scale)
+        self._damage_parser = parser
         # How many frames are skipped at every update.
         self._frame_skip = frame_skip
         self._playernum = playernum
@@ -35,7 +40,13 @@ class DamageTracker(object):
 
     # Record a damage observation from the screen.
     def observe_damage(self, screen):
-        dmg_observation, error = self._damage_parser.GetDamage(self._playernum, screen)
+        self.observe_parsed_damage(
+            self._damage_parser.GetDamage(self._playernum, screen))
+
+    # Record a damage observation already parsed from the screen: the
+    # (damage, error) pair DamageParser returns for this tracker's player.
+    def observe_parsed_damage(self, parsed_damage):
+        dmg_observation, error = parsed_damage
         if error == damage_parser.SUCCESS:
             assert dmg_observation >= 0 and dmg_observation <= 999
             # Reset this counter, since we have detected a % sign.
@@ -96,6 +107,10 @@ class DamageTracker(object):
         self._dmg_at_last_reward = self._curr_dmg
         return (has_died, damage_taken)
 
+    # Return the damage parser's counters (see DamageParser.stats).
+    def get_parse_stats(self):
+        return dict(self._damage_parser.stats)
+
     # Return the current damage.
     def get_curr_damage(self):
         return self._curr_dmg
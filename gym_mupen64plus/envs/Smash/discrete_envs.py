@@ -49,18 +49,19 @@ class SmashDiscreteEnv(SmashEnv):
 
     def __init__(self, my_character='pikachu', their_character='dk',
                  my_character_color='CUP', their_character_color='CLEFT',
-                 opponent_bot_level=10, map='DreamLand'):
+                 opponent_bot_level=10, map='DreamLand', config_overrides=None):
         super(SmashDiscreteEnv, self).__init__(
             my_character=my_character, their_character=their_character,
             my_character_color=my_character_color,
             their_character_color=their_character_color,
-            opponent_bot_level=opponent_bot_level, map=map)
+            opponent_bot_level=opponent_bot_level, map=map,
+            config_overrides=config_overrides)
 
         # This needs to happen after the parent class init to effectively override the action space
         self.action_space = DiscreteActions.get_action_space()
 
-    def _step(self, action):
+    def _get_controls(self, action):
         # Interpret the action choice and get the actual controller state for this step
         controls = DiscreteActions.get_controls_from_action(action)
 
-        return super(SmashDiscreteEnv, self)._step(controls)
+        return super(SmashDiscreteEnv, self)._get_controls(controls)
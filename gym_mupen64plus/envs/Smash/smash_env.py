@@ -22,6 +22,7 @@ class SmashEnv(Mupen64PlusEnv):
     Allows custom stage and characters for self and opponents.
     Attributes:
         _last_dmg_step: int, the last step we took damage
+        _damage_parser: DamageParser reading both players' damage.
         _my_damage_tracker: DamageTracker for the agent's character.
         _their_damage_tracker: DamageTracker for the opponent's character.
         _my_char_pos: (int, int), the (row, col) of agent character in the
@@ -35,10 +36,12 @@ class SmashEnv(Mupen64PlusEnv):
     """
     __metaclass__ = abc.ABCMeta
 
+    RANDOM_MAP_POS = (1, 4)
+
     def __init__(
             self, my_character='pikachu', their_character='dk',
             my_character_color='CUP', their_character_color='CLEFT',
-            opponent_bot_level=10, map='DreamLand'):
+            opponent_bot_level=10, map='DreamLand', config_overrides=None):
         # TODO: Make player number configurable in the future.
         self._set_characters(my_character, their_character)
         self._set_characters_color(my_character_color, their_character_color)
@@ -48,9 +51,9 @@ class SmashEnv(Mupen64PlusEnv):
                 self._my_char_color != self._their_char_color)
         self._set_map(map)
 
-        super(SmashEnv, self).__init__()
-        self._my_damage_tracker = damage_tracker.DamageTracker(self.frame_skip, playernum=1)
-        self._their_damage_tracker = damage_tracker.DamageTracker(self.frame_skip, playernum=2)
+        super(SmashEnv, self).__init__(config_overrides=config_overrides)
+        self._damage_parser = damage_parser.DamageParser(self.screen_scale)
+        self._create_damage_trackers()
         self.action_space = spaces.MultiDiscrete([[-128, 127],  # Joystick X
                                                   [-128, 127],  # Joystick Y
                                                   [  0,  1],    # A
@@ -60,15 +63,29 @@ class SmashEnv(Mupen64PlusEnv):
                                                   [  0,  1],    # Z
                                                   [  0,  1]])   # C
 
-    def _step(self, action):
+    def _get_controls(self, action):
         # Append unneeded inputs.
         num_missing = len(ControllerState.A_BUTTON) - len(action)
         full_action = action + [0] * num_missing
-        return super(SmashEnv, self)._step(full_action)
+        return super(SmashEnv, self)._get_controls(full_action)
+
+    def _menu_signature(self):
+        # A random map would be pinned to whichever one was picked the first time
+        if self._map_pos == self.RANDOM_MAP_POS:
+            return None
+        return (self._my_char_pos, self._their_char_pos,
+                self._my_char_color, self._their_char_color,
+                self._opponent_bot_level, self._map_pos)
+
+    def _create_damage_trackers(self):
+        self._my_damage_tracker = damage_tracker.DamageTracker(
+            self.frame_skip, playernum=1, parser=self._damage_parser)
+        self._their_damage_tracker = damage_tracker.DamageTracker(
+            self.frame_skip, playernum=2, parser=self._damage_parser)
 
     def _reset(self):
-        self._my_damage_tracker = damage_tracker.DamageTracker(self.frame_skip, playernum=1)
-        self._their_damage_tracker = damage_tracker.DamageTracker(self.frame_skip, playernum=2)
+        self._damage_parser.reset()
+        self._create_damage_trackers()
         self._last_dmg_step = 0
 
         # Nothing to do on the first call to reset()
@@ -76,8 +93,9 @@ class SmashEnv(Mupen64PlusEnv):
 
             # Make sure we don't skip frames while navigating the menus
             with self.controller_server.frame_skip_disabled():
-                # TODO: Possibly allow exiting an in-progress map?
-                pass
+                if self.config['USE_SAVESTATES']:
+                    self._load_state()
+                # TODO: Possibly allow exiting an in-progress map (without savestates)?
         return super(SmashEnv, self)._reset()
 
 
@@ -92,8 +110,10 @@ class SmashEnv(Mupen64PlusEnv):
         return 0.0
 
     def _get_dmg_reward(self):
-        self._my_damage_tracker.observe_damage(self.pixel_array)
-        self._their_damage_tracker.observe_damage(self.pixel_array)
+        # Both players' damage is parsed in one pass over the screen.
+        my_dmg, their_dmg = self._damage_parser.GetDamages([1, 2], self.pixel_array)
+        self._my_damage_tracker.observe_parsed_damage(my_dmg)
+        self._their_damage_tracker.observe_parsed_damage(their_dmg)
         dmg_factor = 1.0
         death_factor = 200.0
         reward = 0.0
@@ -291,6 +311,6 @@ class SmashEnv(Mupen64PlusEnv):
                 'DreamLand'          : (1, 1),
                 'SectorZ'            : (1, 2),
                 'SaffronCity'        : (1, 3),
-                'Random'             : (1, 4)}
+                'Random'             : self.RANDOM_MAP_POS}
 
         self._map_pos = maps[map]
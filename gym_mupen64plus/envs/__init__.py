@@ -0,0 +1 @@
+from gym_mupen64plus.envs.vector_env import SubprocVectorMupenEnv, VectorMupenEnv, make_vector_env
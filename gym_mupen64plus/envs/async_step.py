@@ -0,0 +1,18 @@
+# asyncio support for the step_async() / step_wait() API. asyncio is Python 3
+# only, so this is not imported by the package; import it explicitly. (It
+# avoids the async/await syntax, so the module still byte-compiles on Python 2.)
+import asyncio
+
+
+def step(env, action):
+    """Steps env without blocking the event loop; await the result.
+
+    env can be a Mupen64PlusEnv (or gym.make()'s env wrapped in a
+    SplitStepTimeLimit), a VectorMupenEnv or a SubprocVectorMupenEnv (with a
+    list of actions). The action is sent right away; the wait for the
+    emulator(s) to play it happens in the loop's default executor, so other
+    coroutines (e.g. inference on the previous batch) run in the meantime.
+    """
+    env.step_async(action)
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, env.step_wait)
@@ -0,0 +1,89 @@
+import sys
+
+PY3_OR_LATER = sys.version_info[0] >= 3
+
+if PY3_OR_LATER:
+    # Python 3 specific definitions
+    from http.client import HTTPConnection
+else:
+    # Python 2 specific definitions
+    from httplib import HTTPConnection
+
+import socket
+
+from gym_mupen64plus.envs.mupen64plus_env import ControllerState, ControllerTCPServer
+
+
+###############################################
+class ControllerClient(object):
+    """Local stand-in for the emulator's input plugin.
+
+    Polls the controller server once per call to `poll()`, the same way the
+    emulator does once per frame, using any of the CONTROLLER_TRANSPORTS.
+    This lets the controller server be exercised (and benchmarked) without
+    mupen64plus, Xvfb or a ROM.
+    """
+
+    def __init__(self, port, host='localhost', transport='http', wire_format='json'):
+        self.host = host
+        self.port = port
+        self.transport = transport
+        self.wire_format = wire_format
+        self._connection = None
+
+    def poll(self):
+        """Requests the controls for one frame.
+
+        Returns a (status, controls) pair where status mirrors the HTTP status
+        code (200 or 500 on shutdown) and controls is the decoded
+        ControllerState, or None when the server is shutting down.
+        """
+        if self.transport == 'tcp':
+            status, body = self._poll_tcp()
+        else:
+            status, body = self._poll_http()
+
+        if status != 200:
+            return status, None
+        if self.wire_format == 'binary':
+            return status, ControllerState.from_binary(body)
+        return status, ControllerState.from_json(body)
+
+    def _poll_http(self):
+        if self._connection is None:
+            self._connection = HTTPConnection(self.host, self.port)
+
+        # mupen64plus-input-bot opens a new connection for every frame
+        headers = {} if self.transport == 'http-keepalive' else {'Connection': 'close'}
+        self._connection.request('GET', '/', headers=headers)
+        response = self._connection.getresponse()
+        body = response.read()
+
+        if self.transport != 'http-keepalive' or response.will_close:
+            self.close()
+        return response.status, body
+
+    def _poll_tcp(self):
+        if self._connection is None:
+            self._connection = socket.create_connection((self.host, self.port))
+            self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._rfile = self._connection.makefile('rb')
+
+        self._connection.sendall(ControllerTCPServer.POLL_REQUEST)
+        header = self._rfile.read(ControllerTCPServer.RESPONSE_HEADER.size)
+        if len(header) < ControllerTCPServer.RESPONSE_HEADER.size:
+            self.close()
+            return 500, b''
+        status, length = ControllerTCPServer.RESPONSE_HEADER.unpack(header)
+        body = self._rfile.read(length)
+
+        if status != 200:
+            self.close()
+        return status, body
+
+    def close(self):
+        if self._connection is not None:
+            if self.transport == 'tcp':
+                self._rfile.close()
+            self._connection.close()
+            self._connection = None
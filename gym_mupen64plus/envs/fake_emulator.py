@@ -0,0 +1,139 @@
+import argparse
+import mmap
+import os
+import socket
+import time
+
+import numpy as np
+
+from gym_mupen64plus.envs.controller_client import ControllerClient
+from gym_mupen64plus.envs.mupen64plus_env import CONTENT_TYPES, CONTROLLER_TRANSPORTS
+from gym_mupen64plus.envs.screen_capture import XvfbFramebufferCapture
+
+
+###############################################
+class FakeEmulator(object):
+    """Stand-in for mupen64plus (with mupen64plus-input-bot) and Xvfb.
+
+    Polls the controller server once per frame, as the input plugin does, and
+    draws a synthetic frame into an XWD framebuffer file laid out like the one
+    Xvfb keeps with `-fbdir`, so the env can capture it with the framebuffer
+    CAPTURE_BACKEND. Each frame moves a block across the screen, colored by
+    the controls received, so consecutive frames differ like a game's would.
+
+    This lets the controller server, the frame skip handshake and the env's
+    step loop be run and benchmarked without mupen64plus, Xvfb or a ROM.
+    Run it with `python -m gym_mupen64plus.envs.fake_emulator`.
+    """
+
+    WINDOW_NAME = b'fake_emulator\0'
+    BLOCK_SIZE = 32
+
+    def __init__(self, port, host='localhost', transport='http', wire_format='json',
+                 fps=0, framebuffer_path=None, width=640, height=480):
+        self.client = ControllerClient(port, host=host, transport=transport, wire_format=wire_format)
+        # The emulator's frame rate; 0 plays frames as fast as the controls are served
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.frames = 0
+        self._screen = None
+        if framebuffer_path is not None:
+            self._screen = self._create_framebuffer(framebuffer_path)
+
+    def _create_framebuffer(self, path):
+        # The XWD header of a 32 bit TrueColor ZPixmap, with no colormap (see
+        # XvfbFramebufferCapture), followed by the BGRA pixels
+        header_size = XvfbFramebufferCapture.XWD_HEADER.size + len(self.WINDOW_NAME)
+        bytes_per_line = self.width * 4
+        header = [0] * 25
+        header[XvfbFramebufferCapture.HEADER_SIZE] = header_size
+        header[1] = 7 # file version
+        header[2] = 2 # ZPixmap
+        header[3] = 24 # depth
+        header[XvfbFramebufferCapture.PIXMAP_WIDTH] = self.width
+        header[XvfbFramebufferCapture.PIXMAP_HEIGHT] = self.height
+        header[XvfbFramebufferCapture.BYTE_ORDER] = XvfbFramebufferCapture.LSB_FIRST
+        header[8] = header[10] = 32 # bitmap unit and pad
+        header[XvfbFramebufferCapture.BITS_PER_PIXEL] = 32
+        header[XvfbFramebufferCapture.BYTES_PER_LINE] = bytes_per_line
+        header[13] = 4 # TrueColor
+        header[14:17] = [0xff0000, 0xff00, 0xff] # red, green and blue masks
+        header[17] = 8 # bits per RGB
+        header[18] = 256 # colormap entries
+        header[20:22] = [self.width, self.height] # window size
+
+        # Written to a temporary file and renamed, so the env never maps a partial file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fb_file:
+            fb_file.write(XvfbFramebufferCapture.XWD_HEADER.pack(*header) + self.WINDOW_NAME)
+            fb_file.truncate(header_size + bytes_per_line * self.height)
+        os.rename(tmp_path, path)
+
+        with open(path, 'r+b') as fb_file:
+            self._mmap = mmap.mmap(fb_file.fileno(), 0)
+        screen = np.frombuffer(self._mmap, dtype=np.uint8, offset=header_size)
+        return screen.reshape(self.height, self.width, 4)
+
+    def _draw_frame(self, controls):
+        # Erase the block drawn last frame and draw it one step further along
+        size = self.BLOCK_SIZE
+        columns = max(self.width // size, 1)
+        rows = max(self.height // size, 1)
+        for frame, color in ((self.frames - 1, 0), (self.frames, None)):
+            x = (frame % columns) * size
+            y = (frame // columns % rows) * size
+            block = self._screen[y:y + size, x:x + size]
+            if color is None:
+                x_axis, y_axis = controls.controls[:2]
+                block[...] = (x_axis & 0xff, y_axis & 0xff, 255 if any(controls.controls[2:]) else 128, 255)
+            else:
+                block[...] = color
+
+    def run(self, max_frames=None):
+        """Plays frames until the controller server shuts down (or the
+        connection is lost) or max_frames have been played.
+        """
+        start = time.time()
+        try:
+            while max_frames is None or self.frames < max_frames:
+                try:
+                    status, controls = self.client.poll()
+                except (IOError, socket.error):
+                    break # The server has gone away
+                if status != 200:
+                    break
+                if self._screen is not None:
+                    self._draw_frame(controls)
+                self.frames += 1
+
+                if self.fps > 0:
+                    delay = start + self.frames / float(self.fps) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            self.client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in for mupen64plus, for benchmarking the env.')
+    parser.add_argument('--port', type=int, required=True, help="the controller server's port")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--transport', default='http', choices=CONTROLLER_TRANSPORTS)
+    parser.add_argument('--wire-format', default='json', choices=sorted(CONTENT_TYPES))
+    parser.add_argument('--fps', type=float, default=0,
+                        help='frames per second to play at; 0 for as fast as possible')
+    parser.add_argument('--framebuffer', help='the framebuffer file to draw the frames into')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--max-frames', type=int, help='exit after playing this many frames')
+    args = parser.parse_args()
+
+    emulator = FakeEmulator(args.port, host=args.host, transport=args.transport,
+                            wire_format=args.wire_format, fps=args.fps,
+                            framebuffer_path=args.framebuffer, width=args.width, height=args.height)
+    emulator.run(max_frames=args.max_frames)
+
+
+if __name__ == '__main__':
+    main()
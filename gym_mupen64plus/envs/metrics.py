@@ -0,0 +1,162 @@
+import sys
+
+PY3_OR_LATER = sys.version_info[0] >= 3
+
+if PY3_OR_LATER:
+    # Python 3 specific definitions
+    from time import perf_counter as clock
+else:
+    # Python 2 specific definitions
+    from time import time as clock
+
+import bisect
+import collections
+from contextlib import contextmanager
+import json
+import os
+import threading
+
+
+# The upper bounds (in seconds) of the histogram buckets; durations above the
+# last fall into an overflow bucket. Spans the microsecond-scale phases (e.g.
+# computing the reward) up to waiting on the emulator for a whole step.
+HISTOGRAM_BUCKETS = (0.00001, 0.000025, 0.00005,
+                     0.0001, 0.00025, 0.0005,
+                     0.001, 0.0025, 0.005,
+                     0.01, 0.025, 0.05,
+                     0.1, 0.25, 0.5,
+                     1.0, 2.5, 5.0, 10.0)
+
+# The most trace events kept; older events are dropped first.
+MAX_TRACE_EVENTS = 1000000
+
+# Prefix of the metric names on the /metrics endpoint.
+METRICS_PREFIX = 'gym_mupen64plus_'
+
+
+###############################################
+class Histogram(object):
+    """Counts durations (in seconds) into fixed HISTOGRAM_BUCKETS.
+
+    Recording is O(log buckets) with no allocation, so it is cheap enough to
+    time every step. Percentiles are estimated from the buckets: each is the
+    upper bound of the bucket it falls in (or the maximum, for the overflow).
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Estimates the q-th percentile (0-100) of the recorded durations."""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                if index < len(HISTOGRAM_BUCKETS):
+                    return min(HISTOGRAM_BUCKETS[index], self.max)
+                break
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': list(zip(HISTOGRAM_BUCKETS + (float('inf'),), self.counts))}
+
+
+###############################################
+class Metrics(object):
+    """Duration histograms and counters for an env and its controller server.
+
+    Durations are recorded under a name with time(name) (a context manager)
+    or record(name, seconds); counters are incremented with increment(name).
+    snapshot() returns everything recorded so far, and to_prometheus() the
+    same in the Prometheus text format (as served on /metrics).
+
+    With trace=True, every timed span is also kept as a Chrome trace event
+    (up to MAX_TRACE_EVENTS), and write_trace() saves them as a JSON file
+    that chrome://tracing or https://ui.perfetto.dev can display as a
+    timeline, one row per thread.
+    """
+
+    def __init__(self, trace=False):
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.defaultdict(int)
+        self.trace_events = collections.deque(maxlen=MAX_TRACE_EVENTS) if trace else None
+        # Durations are recorded from both the env's and the server's threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, name):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.record(name, clock() - start, start)
+
+    def record(self, name, seconds, start=None):
+        with self._lock:
+            self.histograms[name].record(seconds)
+        if self.trace_events is not None and start is not None:
+            self.trace_events.append({'name': name, 'ph': 'X',
+                                      'ts': start * 1e6, 'dur': seconds * 1e6,
+                                      'pid': os.getpid(), 'tid': threading.current_thread().ident})
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+    def snapshot(self):
+        """Returns {'counters': {name: count}, 'histograms': {name: stats}},
+        where the stats are those of Histogram.snapshot(), in seconds.
+        """
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'histograms': dict((name, histogram.snapshot())
+                                       for name, histogram in self.histograms.items())}
+
+    def to_prometheus(self):
+        lines = []
+        snapshot = self.snapshot()
+        for name, count in sorted(snapshot['counters'].items()):
+            metric = _metric_name(name) + '_total'
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, count))
+        for name, stats in sorted(snapshot['histograms'].items()):
+            metric = _metric_name(name) + '_seconds'
+            lines.append('# TYPE %s histogram' % metric)
+            cumulative = 0
+            for bound, count in stats['buckets']:
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (metric, '+Inf' if bound == float('inf') else repr(bound),
+                                                        cumulative))
+            lines.append('%s_sum %r' % (metric, stats['sum']))
+            lines.append('%s_count %d' % (metric, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_trace(self, path):
+        if self.trace_events is None:
+            raise Exception('Tracing is not enabled')
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': list(self.trace_events), 'displayTimeUnit': 'ms'}, f)
+
+
+def _metric_name(name):
+    return METRICS_PREFIX + name.replace('.', '_')
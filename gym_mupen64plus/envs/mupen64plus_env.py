@@ -5,20 +5,29 @@ PY3_OR_LATER = sys.version_info[0] >= 3
 if PY3_OR_LATER:
     # Python 3 specific definitions
     from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
 else:
     # Python 2 specific definitions
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
 
 import abc
 import array
 from contextlib import contextmanager
+import fcntl
+import gzip
+import hashlib
 import inspect
 import itertools
 import json
 import os
+import shutil
+import struct
 import subprocess
+import tempfile
 import threading
 import time
+import zlib
 from termcolor import cprint
 import yaml
 
@@ -28,7 +37,14 @@ from gym.utils import seeding
 
 import numpy as np
 
-import mss
+import cv2
+
+from gym_mupen64plus.envs.metrics import Metrics, clock
+from gym_mupen64plus.envs.observation import ObservationBuffers, ObservationTransform
+from gym_mupen64plus.envs.recorder import TrajectoryRecorder
+from gym_mupen64plus.envs.screen_capture import \
+    CAPTURE_BACKENDS, MssCapture, XvfbFramebufferCapture, XVFB_SCREEN_FILE
+from gym_mupen64plus.envs.xvfb import start_xvfb
 
 ###############################################
 class ImageHelper:
@@ -45,13 +61,38 @@ class ImageHelper:
 ### Variables & Constants                   ###
 ###############################################
 
-# The width, height, and depth of the emulator window:
+# The native width, height, and depth of the emulator window
+# (game specific screen coordinates are defined at this resolution):
 SCR_W = 640
 SCR_H = 480
 SCR_D = 3
 
 MILLISECOND = 1.0 / 1000.0
 
+# The supported values of the CONTROLLER_TRANSPORT config:
+CONTROLLER_TRANSPORTS = ('http', 'http-keepalive', 'tcp')
+
+# The supported values of the CONTROLLER_WIRE_FORMAT config (and their HTTP content types):
+CONTENT_TYPES = {'json'   : 'application/json',
+                 'binary' : 'application/octet-stream'}
+
+# The supported values of the FRAME_SKIP_POOLING config:
+FRAME_SKIP_POOLING_MODES = ('none', 'max', 'stack')
+
+# The content type of the metrics served on /metrics (the Prometheus text format):
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# The emulator hotkeys (mupen64plus defaults) to save and load the current savestate slot:
+SAVE_STATE_KEY = 'F5'
+LOAD_STATE_KEY = 'F7'
+
+# How many frames to play, at most, while waiting for a savestate to be written:
+SAVE_STATE_TIMEOUT_FRAMES = 120
+
+# The lock file (in the system temp directory) held while typing into a window on an
+# X display, so envs sharing the display never move its focus at the same time:
+DISPLAY_LOCK_FILE = 'gym-mupen64plus-display-%s.lock'
+
 IMAGE_HELPER = ImageHelper()
 
 
@@ -60,53 +101,126 @@ class Mupen64PlusEnv(gym.Env):
     __metaclass__ = abc.ABCMeta
     metadata = {'render.modes': ['human']}
 
-    def __init__(self):
+    # config_overrides is a dict of config values that take precedence over the
+    # config files, e.g. to give each of several envs its own PORT_NUMBER
+    def __init__(self, config_overrides=None):
         self.viewer = None
         self.reset_count = 0
         self.step_count = 0
         self.running = True
         self.episode_over = False
+        self.step_pending = False
         self.pixel_array = None
-        self._base_load_config()
+        self._base_load_config(config_overrides)
         self._base_validate_config()
+        # Timings of each phase of a step, along with the controller server's
+        # (see get_metrics()); every span is also traced if TRACE_FILE is set
+        self.metrics = Metrics(trace=self.config['TRACE_FILE'] is not None)
+        self.step_start = None
+        self.step_action = None
+        self.recorder = None
         self.frame_skip = self.config['FRAME_SKIP']
         if self.frame_skip < 1:
             self.frame_skip = 1
+        self.screen_width = self.config['SCREEN_WIDTH']
+        self.screen_height = self.config['SCREEN_HEIGHT']
+        self.screen_scale = (self.screen_width / float(SCR_W), self.screen_height / float(SCR_H))
+        # Where the emulator window is on the screen (an Xvfb started by the env holds just the window)
+        if self.config['USE_XVFB'] and not self.config['XVFB_DISPLAY']:
+            self.screen_offset = (0, 0)
+        else:
+            self.screen_offset = (self.config['OFFSET_X'], self.config['OFFSET_Y'])
         self.controller_server, self.controller_server_thread = self._start_controller_server()
+        self.port = self.controller_server.server_address[1]
 
-
-        initial_disp = os.environ["DISPLAY"]
-        cprint('Initially on DISPLAY %s' % initial_disp, 'red')
+        # The X display the emulator renders to. We keep track of it here rather than
+        # switching the process-wide DISPLAY env var, so several envs can share a process.
+        self.display = os.environ.get("DISPLAY")
 
         # If the EXTERNAL_EMULATOR environment variable is True, we are running the
         # emulator out-of-process (likely via docker/docker-compose). If not, we need
         # to start the emulator in-process here
-        external_emulator = os.environ.has_key("EXTERNAL_EMULATOR") and os.environ["EXTERNAL_EMULATOR"] == 'True'
+        external_emulator = os.environ.get("EXTERNAL_EMULATOR") == 'True'
+        if external_emulator and self.config['PORT_NUMBER'] == 0:
+            raise AssertionError('PORT_NUMBER must be set explicitly when using an external emulator')
+        if external_emulator and (self.config['USE_SAVESTATES'] or self.config['STARTUP_CACHE']):
+            raise AssertionError('USE_SAVESTATES and STARTUP_CACHE require the emulator to be started in-process')
+        self.fb_dir = None
+        self.state_dir = None
+        self.startup_cache_path = None
+        startup_state = None
         if not external_emulator:
+            if self.config['STARTUP_CACHE']:
+                self.startup_cache_path = self._get_startup_cache_path()
+                startup_state = self._find_startup_state()
             self.xvfb_process, self.emulator_process = \
                 self._start_emulator(rom_name=self.config['ROM_NAME'],
                                      gfx_plugin=self.config['GFX_PLUGIN'],
-                                     input_driver_path=self.config['INPUT_DRIVER_PATH'])
-
-        # TODO: Test and cleanup:
-        # May need to initialize this after the DISPLAY env var has been set
-        # so it attaches to the correct X display; otherwise screenshots may
-        # come from the wrong place. This used to be true when we were using
-        # wxPython for screenshots. Untested after switching to mss.
-        cprint('Calling mss.mss() with DISPLAY %s' % os.environ["DISPLAY"], 'red')
-        self.mss_grabber = mss.mss()
-        time.sleep(2) # Give mss a couple seconds to initialize; also may not be necessary
-
-        # Restore the DISPLAY env var
-        os.environ["DISPLAY"] = initial_disp
-        cprint('Changed back to DISPLAY %s' % os.environ["DISPLAY"], 'red')
-        
+                                     input_driver_path=self.config['INPUT_DRIVER_PATH'],
+                                     res_w=self.screen_width,
+                                     res_h=self.screen_height,
+                                     startup_state=startup_state)
+            self._wait_for_emulator()
+
+        self.screen_capture = self._start_screen_capture()
+        self.observation_transform = \
+            ObservationTransform((self.screen_height, self.screen_width, SCR_D),
+                                 crop         = self.config['OBS_CROP'],
+                                 width        = self.config['OBS_WIDTH'],
+                                 height       = self.config['OBS_HEIGHT'],
+                                 grayscale    = self.config['OBS_GRAYSCALE'],
+                                 dtype        = self.config['OBS_DTYPE'],
+                                 buffer_count = self.config['OBSERVATION_BUFFERS'])
+        self.frame_skip_pooling = self.config['FRAME_SKIP_POOLING']
+        pool_size = self.config['FRAME_SKIP_POOL_SIZE'] if self.frame_skip_pooling != 'none' else 1
+        screen_shape = (self.screen_height, self.screen_width, SCR_D)
+        # When the observation is derived from the screen, the screen pixels are
+        # never handed off, so a single buffer can be reused for them
+        pixels_observed = self.observation_transform.identity and self.frame_skip_pooling == 'none'
+        self.observation_buffers = \
+            ObservationBuffers(screen_shape, count=self.config['OBSERVATION_BUFFERS'] if pixels_observed else 1)
+
+        # The last few frames played while skipping frames are captured (on the
+        # controller server's thread) for pooling along with the final one
+        self.skipped_frames = [np.empty(screen_shape, dtype=np.uint8) for _ in range(pool_size - 1)]
+        self.skipped_frame_count = 0
+        # Kept when screen_capture is replaced by a SharedScreenCapture: skipped frames
+        # are played at different times in each env, so they can't share its grabs
+        self.skipped_frame_capture = self.screen_capture
+        observation_shape = self.observation_transform.shape
+        if self.frame_skip_pooling == 'max':
+            self.pooled_buffers = \
+                ObservationBuffers(screen_shape,
+                                   count=self.config['OBSERVATION_BUFFERS'] if self.observation_transform.identity else 1)
+        elif self.frame_skip_pooling == 'stack':
+            observation_shape = (pool_size,) + observation_shape
+            self.stacked_buffers = ObservationBuffers(observation_shape,
+                                                      dtype=self.observation_transform.dtype,
+                                                      count=self.config['OBSERVATION_BUFFERS'])
+        if self.skipped_frames:
+            self.controller_server.on_frame = self._on_skipped_frame
 
         with self.controller_server.frame_skip_disabled():
-            self._navigate_menu()
+            if startup_state is not None:
+                # The emulator was started from the cached snapshot taken after the menus
+                self._wait(count=2, wait_for='startup savestate to load')
+                shutil.copy(startup_state, self.state_dir)
+            else:
+                self._navigate_menu()
+                # Snapshot the start of the episode so resets (and later envs) can jump straight back to it
+                if self.state_dir is not None:
+                    self._save_state()
+                if self.startup_cache_path is not None:
+                    self._store_startup_state()
 
         self.observation_space = \
-            spaces.Box(low=0, high=255, shape=(SCR_H, SCR_W, SCR_D))
+            spaces.Box(low=0, high=self.observation_transform.high, shape=observation_shape)
+
+        if self.config['RECORD_DIR'] is not None:
+            self.recorder = TrajectoryRecorder(self.config['RECORD_DIR'].format(port=self.port),
+                                               chunk_size      = self.config['RECORD_CHUNK_SIZE'],
+                                               queue_size      = self.config['RECORD_QUEUE_SIZE'],
+                                               block_when_full = self.config['RECORD_BLOCK_WHEN_FULL'])
 
         self.action_space = spaces.MultiDiscrete([[-80, 80], # Joystick X-axis
                                                   [-80, 80], # Joystick Y-axis
@@ -126,9 +240,11 @@ class Mupen64PlusEnv(gym.Env):
                                                   [  0,  1], # Start Button
                                                  ])
 
-    def _base_load_config(self):
+    def _base_load_config(self, config_overrides=None):
         self.config = yaml.safe_load(open(os.path.join(os.path.dirname(inspect.stack()[0][1]), "config.yml")))
         self._load_config()
+        if config_overrides:
+            self.config.update(config_overrides)
 
     @abc.abstractmethod
     def _load_config(self):
@@ -139,6 +255,21 @@ class Mupen64PlusEnv(gym.Env):
             raise AssertionError('ROM_NAME configuration is required')
         if 'GFX_PLUGIN' not in self.config:
             raise AssertionError('GFX_PLUGIN configuration is required')
+        if self.config['CAPTURE_BACKEND'] not in CAPTURE_BACKENDS:
+            raise AssertionError('CAPTURE_BACKEND must be one of: %s' % ', '.join(CAPTURE_BACKENDS))
+        if self.config['CONTROLLER_TRANSPORT'] not in CONTROLLER_TRANSPORTS:
+            raise AssertionError('CONTROLLER_TRANSPORT must be one of: %s' % ', '.join(CONTROLLER_TRANSPORTS))
+        if self.config['CONTROLLER_WIRE_FORMAT'] not in CONTENT_TYPES:
+            raise AssertionError('CONTROLLER_WIRE_FORMAT must be one of: %s' % ', '.join(sorted(CONTENT_TYPES)))
+        if self.config['FRAME_SKIP_POOLING'] not in FRAME_SKIP_POOLING_MODES:
+            raise AssertionError('FRAME_SKIP_POOLING must be one of: %s' % ', '.join(FRAME_SKIP_POOLING_MODES))
+        if self.config['FRAME_SKIP_POOLING'] != 'none' and \
+           not 2 <= self.config['FRAME_SKIP_POOL_SIZE'] < self.config['FRAME_SKIP']:
+            # The final frame is observed before it's drawn (see _on_skipped_frame()),
+            # so only FRAME_SKIP - 1 distinct frames can be captured per step
+            raise AssertionError('FRAME_SKIP_POOL_SIZE must be between 2 and FRAME_SKIP - 1')
+        if self.config['METRICS_ENDPOINT'] and self.config['CONTROLLER_TRANSPORT'] == 'tcp':
+            raise AssertionError('METRICS_ENDPOINT requires an http CONTROLLER_TRANSPORT')
         self._validate_config()
 
     @abc.abstractmethod
@@ -146,18 +277,69 @@ class Mupen64PlusEnv(gym.Env):
         return
 
     def _step(self, action):
+        self.step_async(action)
+        return self.step_wait()
+
+    def step_async(self, action):
+        """Sends the action to the emulator and returns without waiting for
+        its frames to be played; call step_wait() to get the step's results.
+        """
+        if self.step_pending:
+            raise Exception('step_async() called again before step_wait()')
         #cprint('Step %i: %s' % (self.step_count, action), 'green')
-        self._act(action)
-        obs = self._observe()
-        self.episode_over = self._evaluate_end_state()
-        reward = self._get_reward()
+        self.step_start = clock()
+        self.step_action = action
+        self.controller_server.send_controls_async(ControllerState(self._get_controls(action)))
+        self.step_pending = True
+
+    def step_wait(self):
+        """Waits for the action sent by step_async() to be played and returns
+        the (observation, reward, done, info) for the step.
+        """
+        if not self.step_pending:
+            raise Exception('step_wait() called without a preceding step_async()')
+        with self.metrics.time('step.act'):
+            self.controller_server.wait_for_response()
+        self.step_pending = False
+
+        with self.metrics.time('step.observe'):
+            obs = self._observe()
+        with self.metrics.time('step.evaluate_end_state'):
+            self.episode_over = self._evaluate_end_state()
+        with self.metrics.time('step.get_reward'):
+            reward = self._get_reward()
+        if self.recorder is not None:
+            with self.metrics.time('step.record'):
+                self.recorder.record_step(self.step_count, self.step_action, obs, reward, self.episode_over)
 
         self.step_count += 1
+        self.metrics.record('step', clock() - self.step_start, self.step_start)
         return obs, reward, self.episode_over, {}
 
+    def get_metrics(self):
+        """Returns the durations and counts recorded so far, as
+        {'counters': {name: count}, 'histograms': {name: stats}}.
+
+        The histograms (in seconds) are 'step' (from step_async() to the end
+        of step_wait()) and its phases: 'step.act' (waiting for the emulator
+        to play the action's frames), 'step.observe', 'step.evaluate_end_state'
+        and 'step.get_reward' (and 'step.record', when recording); and the
+        controller server's 'server.controls_wait' (the emulator's requests
+        waiting for an action) and 'server.send_controls_blocked' (the env
+        waiting for the frames to be played, including while navigating
+        menus). The counter 'server.frames_served' counts the emulator's
+        requests answered.
+        """
+        return self.metrics.snapshot()
+
+    def _get_controls(self, action):
+        # Game environments override this to map their action space onto the full controller state
+        return action
+
     def _act(self, action, count=1):
+        controls = ControllerState(action)
         for _ in itertools.repeat(None, count):
-            self.controller_server.send_controls(ControllerState(action))
+            self.controller_server.send_controls(controls)
 
     def _wait(self, count=1, wait_for='Unknown'):
         self._act(ControllerState.NO_OP, count=count)
@@ -167,27 +349,195 @@ class Mupen64PlusEnv(gym.Env):
             self._act(button) # Press
             self._act(ControllerState.NO_OP) # and release
 
+    def _save_state(self):
+        # Saves a snapshot of the emulator into the current savestate slot.
+        # The emulator saves at a frame boundary (and may finish writing the
+        # file in the background), so play frames until the file is complete.
+        # A size that stops changing may just be a stalled write, so the file
+        # must also decompress to the end before it's accepted.
+        state_files = self._state_files()
+        for path in state_files:
+            os.remove(path)
+        self._send_emulator_key(SAVE_STATE_KEY)
+
+        last_size = -1
+        for _ in itertools.repeat(None, SAVE_STATE_TIMEOUT_FRAMES):
+            self._wait(count=1, wait_for='savestate to be written')
+            state_files = self._state_files()
+            size = os.path.getsize(state_files[0]) if state_files else 0
+            if size > 0 and size == last_size and self._is_state_complete(state_files[0]):
+                cprint('Saved state to %s' % state_files[0], 'blue')
+                return
+            last_size = size
+
+        msg = "Timed out waiting for the emulator to save its state in " + self.state_dir
+        cprint(msg, 'red')
+        raise Exception(msg)
+
+    @staticmethod
+    def _is_state_complete(path):
+        # mupen64plus writes savestates gzip compressed; a truncated file fails
+        # to decompress to the end (or its CRC check fails). Python 2's gzip
+        # raises struct.error for a missing trailer.
+        try:
+            with gzip.open(path, 'rb') as state_file:
+                while state_file.read(1024 * 1024):
+                    pass
+        except (IOError, EOFError, struct.error, zlib.error):
+            return False
+        return True
+
+    def _load_state(self):
+        # Restores the snapshot taken by _save_state(); the emulator loads it at the next frame
+        self._send_emulator_key(LOAD_STATE_KEY)
+        self._wait(count=2, wait_for='savestate to load')
+
+    def _menu_signature(self):
+        # Game environments return the menu choices _navigate_menu() makes (e.g.
+        # character and course), or None when the result can't be cached
+        return None
+
+    def _get_startup_cache_path(self):
+        # The cache entry for this ROM, menu choices, graphics plugin and resolution (None if not cacheable)
+        signature = self._menu_signature()
+        if signature is None:
+            return None
+
+        key = hashlib.sha1()
+        with open(self._get_rom_path(self.config['ROM_NAME']), 'rb') as rom_file:
+            key.update(rom_file.read())
+        key.update(repr((tuple(signature),
+                         self.config['GFX_PLUGIN'],
+                         self.screen_width,
+                         self.screen_height)).encode('utf-8'))
+        return os.path.join(os.path.expanduser(self.config['STARTUP_CACHE_DIR']), key.hexdigest())
+
+    def _find_startup_state(self):
+        if self.startup_cache_path is None or not os.path.isdir(self.startup_cache_path):
+            return None
+        state_files = os.listdir(self.startup_cache_path)
+        if not state_files:
+            return None
+        cprint('Starting from cached savestate in %s' % self.startup_cache_path, 'blue')
+        return os.path.join(self.startup_cache_path, state_files[0])
+
+    def _store_startup_state(self):
+        # Copy the savestate into the cache under a temporary name, then move it
+        # into place, so concurrently starting envs never see a partial entry
+        cache_dir = os.path.dirname(self.startup_cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        staging_path = tempfile.mkdtemp(prefix='.staging-', dir=cache_dir)
+        shutil.copy(self._state_files()[0], staging_path)
+        # A truncated entry would be loaded by every later run, so check the copy too
+        staged_file = os.path.join(staging_path, os.listdir(staging_path)[0])
+        if not self._is_state_complete(staged_file):
+            cprint('Not caching incomplete savestate %s' % self._state_files()[0], 'red')
+            shutil.rmtree(staging_path, ignore_errors=True)
+            return
+        try:
+            os.rename(staging_path, self.startup_cache_path)
+            cprint('Cached startup savestate in %s' % self.startup_cache_path, 'blue')
+        except OSError:
+            shutil.rmtree(staging_path, ignore_errors=True) # Another env cached it first
+
+    def _state_files(self):
+        return [os.path.join(self.state_dir, name) for name in os.listdir(self.state_dir)]
+
+    def _send_emulator_key(self, key):
+        # mupen64plus only takes savestate commands through its hotkeys, so type
+        # the key into this env's emulator window. With XVFB_DISPLAY set (or
+        # USE_XVFB off) several envs share one display, so focus the window found
+        # by our emulator's pid first. Focusing and typing are separate requests,
+        # so hold the display's lock across both: another env (in this process or
+        # another) could otherwise take the focus in between and get our key.
+        xdotool_env = os.environ.copy()
+        if self.display is not None:
+            xdotool_env["DISPLAY"] = self.display
+        with self._display_lock():
+            subprocess.check_call([self.config['XDOTOOL_CMD'], "search", "--sync", "--pid",
+                                   str(self.emulator_process.pid), "windowfocus", "--sync", "key", key],
+                                  env=xdotool_env)
+
+    @contextmanager
+    def _display_lock(self):
+        # An exclusive lock on a file named after the display; flock() locks are held
+        # per open file, so this excludes other threads as well as other processes
+        display = (self.display or 'default').replace(':', '').replace('/', '_')
+        with open(os.path.join(tempfile.gettempdir(), DISPLAY_LOCK_FILE % display), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _start_screen_capture(self):
+        if self.config['CAPTURE_BACKEND'] == 'framebuffer':
+            fb_path = self.config['FRAMEBUFFER_PATH']
+            if fb_path is None:
+                if self.fb_dir is None:
+                    msg = "The framebuffer capture backend requires USE_XVFB or FRAMEBUFFER_PATH"
+                    cprint(msg, 'red')
+                    raise Exception(msg)
+                fb_path = os.path.join(self.fb_dir, XVFB_SCREEN_FILE)
+            cprint('Capturing screen from framebuffer %s' % fb_path, 'red')
+            return XvfbFramebufferCapture(fb_path)
+
+        cprint('Calling mss.mss() with DISPLAY %s' % self.display, 'red')
+        return MssCapture(self.display)
+
     def _observe(self):
         #cprint('Observe called!', 'yellow')
 
-        if self.config['USE_XVFB']:
-            offset_x = 0
-            offset_y = 0
-        else:
-            offset_x = self.config['OFFSET_X']
-            offset_y = self.config['OFFSET_Y']
+        self.pixel_array = self.observation_buffers.acquire()
+        self._capture_frame(self.pixel_array)
 
-        image_array = \
-            np.array(self.mss_grabber.grab({"top": offset_y,
-                                            "left": offset_x,
-                                            "width": SCR_W,
-                                            "height": SCR_H}),
-                     dtype=np.uint8)
+        # pixel_array stays full resolution (and unpooled) for reward and end-state detection
+        if self.frame_skip_pooling == 'none':
+            return self.observation_transform.apply(self.pixel_array)
 
-        # drop the alpha channel and flip red and blue channels (BGRA -> RGB)
-        self.pixel_array = np.flip(image_array[:, :, :3], 2)
+        frames = self.skipped_frames[:self.skipped_frame_count] + [self.pixel_array]
+        self.skipped_frame_count = 0
 
-        return self.pixel_array
+        if self.frame_skip_pooling == 'max':
+            pooled = self.pooled_buffers.acquire()
+            if len(frames) == 1:
+                np.copyto(pooled, frames[0])
+            else:
+                np.maximum(frames[0], frames[1], out=pooled)
+                for frame in frames[2:]:
+                    np.maximum(pooled, frame, out=pooled)
+            return self.observation_transform.apply(pooled)
+
+        # Any frames missing (e.g. after a reset) are filled in with the earliest one
+        stacked = self.stacked_buffers.acquire()
+        frames = [frames[0]] * (len(stacked) - len(frames)) + frames
+        for index, frame in enumerate(frames):
+            stacked[index] = self.observation_transform.apply(frame)
+        return stacked
+
+    def _capture_frame(self, pixels, screen_capture=None):
+        image_array = (screen_capture or self.screen_capture).grab(self.screen_offset[0], self.screen_offset[1],
+                                               self.screen_width, self.screen_height)
+
+        # drop the alpha channel and flip red and blue channels (BGRA -> RGB),
+        # in a single pass straight into the given buffer
+        cv2.cvtColor(image_array, cv2.COLOR_BGRA2RGB, dst=pixels)
+
+    def _on_skipped_frame(self, frames_played):
+        # Called by the controller server once the emulator has played frames_played
+        # of the step's frame_skip frames; keep the last few for pooling. The step
+        # ends as soon as the last frame's controls are served, before that frame is
+        # drawn, so _observe() grabs frame frame_skip - 1: capture the frames before it.
+        first_frame = max(self.frame_skip - 1 - len(self.skipped_frames), 1)
+        slot = frames_played - first_frame
+        if slot >= 0 and frames_played < self.frame_skip - 1:
+            self._capture_frame(self.skipped_frames[slot], self.skipped_frame_capture)
+            self.skipped_frame_count = slot + 1
+
+    def _scale_point(self, x, y):
+        # Converts a point on the native (SCR_W x SCR_H) screen to the configured resolution
+        return int(x * self.screen_scale[0]), int(y * self.screen_scale[1])
 
     @abc.abstractmethod
     def _navigate_menu(self):
@@ -209,7 +559,10 @@ class Mupen64PlusEnv(gym.Env):
         self.reset_count += 1
 
         self.step_count = 0
-        return self._observe()
+        obs = self._observe()
+        if self.recorder is not None:
+            self.recorder.record_reset(obs)
+        return obs
 
     def _render(self, mode='human', close=False):
         if close:
@@ -231,15 +584,37 @@ class Mupen64PlusEnv(gym.Env):
         self.running = False
         self._kill_emulator()
         self._stop_controller_server()
+        if self.recorder is not None:
+            self.recorder.close()
+            cprint('Recorder stats: %s' % self.recorder.stats, 'yellow')
+        if self.config['TRACE_FILE'] is not None:
+            trace_file = os.path.expanduser(self.config['TRACE_FILE'].format(port=self.port))
+            self.metrics.write_trace(trace_file)
+            cprint('Wrote trace to %s' % trace_file, 'yellow')
 
     def _start_controller_server(self):
-        server = ControllerHTTPServer(server_address  = ('', self.config['PORT_NUMBER']),
-                                      control_timeout = self.config['ACTION_TIMEOUT'],
-                                      frame_skip      = self.frame_skip) # TODO: Environment argument (with issue #26)
+        transport = self.config['CONTROLLER_TRANSPORT']
+        if transport == 'tcp':
+            server = ControllerTCPServer(server_address  = ('', self.config['PORT_NUMBER']),
+                                         control_timeout = self.config['ACTION_TIMEOUT'],
+                                         frame_skip      = self.frame_skip,
+                                         wire_format     = self.config['CONTROLLER_WIRE_FORMAT'],
+                                         metrics         = self.metrics)
+        else:
+            # /metrics must be answerable while the emulator's request waits for an action
+            server_class = ThreadingControllerHTTPServer if self.config['METRICS_ENDPOINT'] \
+                           else ControllerHTTPServer
+            server = server_class(server_address   = ('', self.config['PORT_NUMBER']),
+                                  control_timeout  = self.config['ACTION_TIMEOUT'],
+                                  frame_skip       = self.frame_skip, # TODO: Environment argument (with issue #26)
+                                  keep_alive       = transport == 'http-keepalive',
+                                  wire_format      = self.config['CONTROLLER_WIRE_FORMAT'],
+                                  metrics          = self.metrics,
+                                  metrics_endpoint = self.config['METRICS_ENDPOINT'])
         server_thread = threading.Thread(target=server.serve_forever, args=())
         server_thread.daemon = True
         server_thread.start()
-        print('ControllerHTTPServer started on port ', self.config['PORT_NUMBER'])
+        print('%s started on port ' % type(server).__name__, server.server_address[1])
         return server, server_thread
 
     def _stop_controller_server(self):
@@ -247,18 +622,22 @@ class Mupen64PlusEnv(gym.Env):
         if hasattr(self, 'controller_server'):
             self.controller_server.shutdown()
 
+    def _get_rom_path(self, rom_name):
+        return os.path.abspath(
+            os.path.join(os.path.dirname(inspect.stack()[0][1]),
+                         '../ROMs',
+                         rom_name))
+
     def _start_emulator(self,
                         rom_name,
                         gfx_plugin,
                         input_driver_path,
                         res_w=SCR_W,
                         res_h=SCR_H,
-                        res_d=SCR_D):
+                        res_d=SCR_D,
+                        startup_state=None):
 
-        rom_path = os.path.abspath(
-            os.path.join(os.path.dirname(inspect.stack()[0][1]),
-                         '../ROMs',
-                         rom_name))
+        rom_path = self._get_rom_path(rom_name)
 
         if not os.path.isfile(rom_path):
             msg = "ROM not found: " + rom_path
@@ -271,6 +650,9 @@ class Mupen64PlusEnv(gym.Env):
             cprint(msg, 'red')
             raise Exception(msg)
 
+        # mupen64plus-input-bot reads the port it polls from its Input-Bot-Control0
+        # config section, defaulting to 8082 ("missing 'port' parameter. Set to 8082"
+        # in docs/example_script_output.md); --set overrides it for this run only
         cmd = [self.config['MUPEN_CMD'],
                "--nospeedlimit",
                "--nosaveoptions",
@@ -279,51 +661,43 @@ class Mupen64PlusEnv(gym.Env):
                "--gfx", gfx_plugin,
                "--audio", "dummy",
                "--input", input_driver_path,
-               rom_path]
-
-        xvfb_proc = None
-        if self.config['USE_XVFB']:
-            display_num = -1
-            success = False
-            # If we couldn't find an open display number after 15 attempts, give up
-            while not success and display_num <= 15:
-                display_num += 1
-                xvfb_cmd = [self.config['XVFB_CMD'],
-                            ":" + str(display_num),
-                            "-screen",
-                            "0",
-                            "%ix%ix%i" % (res_w, res_h, res_d * 8),
-                            "-fbdir",
-                            self.config['TMP_DIR']]
-
-                cprint('Starting xvfb with command: %s' % xvfb_cmd, 'yellow')
+               "--set", "Input-Bot-Control0[port]=%i" % self.port]
 
-                xvfb_proc = subprocess.Popen(xvfb_cmd, shell=False, stderr=subprocess.STDOUT)
+        if self.config['USE_SAVESTATES'] or self.config['STARTUP_CACHE']:
+            # Each env gets its own savestate directory so multiple emulators
+            # don't load each other's snapshots
+            self.state_dir = tempfile.mkdtemp(prefix='gym-mupen64plus-states-', dir=self.config['TMP_DIR'])
+            cmd += ["--set", "Core[SaveStatePath]=%s" % os.path.join(self.state_dir, '')]
+        if startup_state is not None:
+            cmd += ["--savestate", startup_state]
 
-                time.sleep(2) # Give xvfb a couple seconds to start up
+        cmd.append(rom_path)
 
-                # Poll the process to see if it exited early
-                # (most likely due to a server already active on the display_num)
-                if xvfb_proc.poll() is None:
-                    success = True
-
-                print('') # new line
-
-            if not success:
-                msg = "Failed to initialize Xvfb!"
-                cprint(msg, 'red')
-                raise Exception(msg)
-
-            os.environ["DISPLAY"] = ":" + str(display_num)
-            cprint('Using DISPLAY %s' % os.environ["DISPLAY"], 'blue')
-            cprint('Changed to DISPLAY %s' % os.environ["DISPLAY"], 'red')
-
-            cmd = [self.config['VGLRUN_CMD'], "-d", ":" + str(display_num)] + cmd
+        xvfb_proc = None
+        if self.config['XVFB_DISPLAY']:
+            # Render to an existing (shared) X display, in the window at OFFSET_X/OFFSET_Y
+            self.display = self.config['XVFB_DISPLAY']
+            cprint('Using DISPLAY %s' % self.display, 'blue')
+
+            cmd = [self.config['VGLRUN_CMD'], "-d", self.display] + cmd
+        elif self.config['USE_XVFB']:
+            # Each env gets its own framebuffer directory so multiple Xvfb
+            # instances don't share (and overwrite) the same screen file
+            self.fb_dir = tempfile.mkdtemp(prefix='gym-mupen64plus-', dir=self.config['TMP_DIR'])
+            xvfb_proc, display_num = start_xvfb(self.config['XVFB_CMD'], res_w, res_h, res_d * 8,
+                                                self.fb_dir, self.config['STARTUP_TIMEOUT'])
+            self.display = ":" + str(display_num)
+            cprint('Using DISPLAY %s' % self.display, 'blue')
+
+            cmd = [self.config['VGLRUN_CMD'], "-d", self.display] + cmd
 
         cprint('Starting emulator with comand: %s' % cmd, 'yellow')
 
+        emulator_env = os.environ.copy()
+        if self.display is not None:
+            emulator_env["DISPLAY"] = self.display
         emulator_process = subprocess.Popen(cmd,
-                                            env=os.environ.copy(),
+                                            env=emulator_env,
                                             shell=False,
                                             stderr=subprocess.STDOUT)
 
@@ -335,6 +709,27 @@ class Mupen64PlusEnv(gym.Env):
 
         return xvfb_proc, emulator_process
 
+    def _wait_for_emulator(self):
+        # The emulator is up (with its window created) once it starts polling for controls
+        if not self.controller_server.first_request.wait(self.config['STARTUP_TIMEOUT']):
+            msg = "The emulator didn't connect to the controller server within %s seconds" % \
+                  self.config['STARTUP_TIMEOUT']
+            if self.port != 8082:
+                msg += " (on port %i; the input plugin must support the Input-Bot-Control0[port] " \
+                       "parameter, or set PORT_NUMBER to the plugin's port)" % self.port
+            cprint(msg, 'red')
+            raise Exception(msg)
+
+        if self.config['XVFB_DISPLAY']:
+            # Move the window into its place on the shared screen. (There's no
+            # window manager on Xvfb to honor placement hints, so move it directly.)
+            xdotool_env = os.environ.copy()
+            xdotool_env["DISPLAY"] = self.display
+            subprocess.check_call([self.config['XDOTOOL_CMD'],
+                                   "search", "--sync", "--pid", str(self.emulator_process.pid),
+                                   "windowmove", "%i" % self.screen_offset[0], "%i" % self.screen_offset[1]],
+                                  env=xdotool_env)
+
     def _kill_emulator(self):
         #cprint('Kill Emulator called!', 'yellow')
         try:
@@ -343,6 +738,11 @@ class Mupen64PlusEnv(gym.Env):
                 self.emulator_process.kill()
             if self.xvfb_process is not None:
                 self.xvfb_process.terminate()
+                self.xvfb_process.wait()
+            if self.fb_dir is not None:
+                shutil.rmtree(self.fb_dir, ignore_errors=True)
+            if self.state_dir is not None:
+                shutil.rmtree(self.state_dir, ignore_errors=True)
         except AttributeError:
             pass # We may be shut down during intialization before these attributes have been set
 
@@ -363,6 +763,26 @@ class EmulatorMonitor:
         print('Emulator closed with code: ' + str(emu_return))
 
 
+###############################################
+class _ControlField(object):
+    # A read-only ControllerState field, indexing into its controls. Read from the
+    # class, it's the action constant of the same name (A_BUTTON, START_BUTTON),
+    # so ControllerState.A_BUTTON is still the action and state.A_BUTTON the field.
+
+    def __init__(self, index, action=None):
+        self.index = index
+        self.action = action
+
+    def __get__(self, state, owner=None):
+        if state is None:
+            return self if self.action is None else self.action
+        return state.controls[self.index]
+
+    def __set__(self, state, value):
+        # The encodings are cached, so a state can't be changed once created
+        raise AttributeError('ControllerState fields are read-only; create a new ControllerState')
+
+
 ###############################################
 class ControllerState(object):
 
@@ -381,53 +801,126 @@ class ControllerState(object):
     JOYSTICK_LEFT      = [-128,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0]
     JOYSTICK_RIGHT     = [ 127,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0,  0]
 
+    # The field names of the controls (in order), as expected by the input plugin:
+    FIELDS = ('X_AXIS', 'Y_AXIS', 'A_BUTTON', 'B_BUTTON', 'R_TRIG', 'L_TRIG', 'Z_TRIG',
+              'R_CBUTTON', 'L_CBUTTON', 'D_CBUTTON', 'U_CBUTTON',
+              'R_DPAD', 'L_DPAD', 'D_DPAD', 'U_DPAD', 'START_BUTTON')
+
+    # Binary wire format: the signed joystick axes followed by a bitmask of the
+    # 14 buttons (bit 0 is A_BUTTON, bit 13 is START_BUTTON)
+    BINARY_FORMAT = struct.Struct('!bbH')
+
+    __slots__ = ('controls', '_encoded')
+
     def __init__(self, controls=NO_OP):
-        self.X_AXIS = controls[0]
-        self.Y_AXIS = controls[1]
-        self.A_BUTTON = controls[2]
-        self.B_BUTTON = controls[3]
-        self.R_TRIG = controls[4]
-        self.L_TRIG = controls[5]
-        self.Z_TRIG = controls[6]
-        self.R_CBUTTON = controls[7]
-        self.L_CBUTTON = controls[8]
-        self.D_CBUTTON = controls[9]
-        self.U_CBUTTON = controls[10]
-        self.R_DPAD = controls[11]
-        self.L_DPAD = controls[12]
-        self.D_DPAD = controls[13]
-        self.U_DPAD = controls[14]
-        self.START_BUTTON = controls[15]
+        self.controls = tuple(controls)
+        # Encodings are cached, since the same state is served for every frame it is held
+        self._encoded = {}
+
+    def encode(self, wire_format='json'):
+        encoded = self._encoded.get(wire_format)
+        if encoded is None:
+            encoded = self.to_binary() if wire_format == 'binary' else self.to_json().encode()
+            self._encoded[wire_format] = encoded
+        return encoded
 
     def to_json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(dict(zip(self.FIELDS, self.controls)))
+
+    def to_binary(self):
+        buttons = 0
+        for bit, pressed in enumerate(self.controls[2:]):
+            if pressed:
+                buttons |= 1 << bit
+        return self.BINARY_FORMAT.pack(self.controls[0], self.controls[1], buttons)
+
+    @classmethod
+    def from_json(cls, data):
+        fields = json.loads(data.decode())
+        return cls([fields[name] for name in cls.FIELDS])
+
+    @classmethod
+    def from_binary(cls, data):
+        x_axis, y_axis, buttons = cls.BINARY_FORMAT.unpack(data)
+        return cls([x_axis, y_axis] + [(buttons >> bit) & 1 for bit in range(len(cls.FIELDS) - 2)])
+
+# The fields (X_AXIS, A_BUTTON...) as attributes of each ControllerState
+for _index, _name in enumerate(ControllerState.FIELDS):
+    setattr(ControllerState, _name, _ControlField(_index, ControllerState.__dict__.get(_name)))
+del _index, _name
 
 ###############################################
-class ControllerHTTPServer(HTTPServer, object):
+class ControllerServer(object):
+    """Frame handshake shared by each of the controller server transports.
+
+    The emulator polls the server once per frame and the request is held
+    until `send_controls()` supplies the next action. The same controls are
+    then served for `frame_skip` frames before `send_controls()` returns.
+
+    The time spent waiting on either side of the handshake, and the frames
+    served, are recorded in `metrics`.
+    """
 
-    def __init__(self, server_address, control_timeout, frame_skip):
+    def __init__(self, control_timeout, frame_skip, wire_format='json', metrics=None):
         self.control_timeout = control_timeout
+        self.wire_format = wire_format
+        self.metrics = metrics if metrics is not None else Metrics()
         self.controls = ControllerState()
+        self.response_data = self.controls.encode(wire_format)
         self.controls_updated = threading.Event()
         self.response_sent = threading.Event()
+        self.first_request = threading.Event()
+        # Called with the number of frames played so far, each time the emulator
+        # polls for the next frame part way through a step's frame_skip frames
+        self.on_frame = None
         self.running = True
         self.responses_sent = 0
         self.frame_skip = frame_skip
         self.frame_skip_enabled = True
-        super(ControllerHTTPServer, self).__init__(server_address, self.ControllerRequestHandler)
 
     def send_controls(self, controls):
+        self.send_controls_async(controls)
+        self.wait_for_response()
+
+    def send_controls_async(self, controls):
         self.responses_sent = 0
         self.controls = controls
+        # Encode once; the same response is sent for each of the frame_skip frames
+        self.response_data = controls.encode(self.wire_format)
 
         # Tell the request handler that the controls have been updated so it can send the response now:
         self.controls_updated.set()
 
-        # Wait for response to actually be sent before returning:
+    def wait_for_response(self):
+        # Wait for response to actually be sent (frame_skip times) before returning:
         if self.running:
-            self.response_sent.wait()
+            with self.metrics.time('server.send_controls_blocked'):
+                self.response_sent.wait()
             self.response_sent.clear()
 
+    def wait_for_controls(self):
+        if not self.first_request.is_set():
+            self.first_request.set()
+        if self.on_frame is not None and self.frame_skip_enabled and \
+           0 < self.responses_sent < self.frame_skip:
+            self.on_frame(self.responses_sent)
+
+        # Wait for the controls to be updated before responding:
+        if self.running:
+            with self.metrics.time('server.controls_wait'):
+                self.controls_updated.wait()
+        return self.running
+
+    def controls_served(self):
+        self.responses_sent += 1
+        self.metrics.increment('server.frames_served')
+
+        # If we have sent the controls 'n' times now...
+        if self.responses_sent >= self.frame_skip or not self.frame_skip_enabled:
+            # ...we fire the response_sent event so the next action can happen:
+            self.controls_updated.clear()
+            self.response_sent.set()
+
     def shutdown(self):
         self.running = False
 
@@ -436,12 +929,8 @@ class ControllerHTTPServer(HTTPServer, object):
         self.controls_updated.set()
 
         # Shutdown the server:
-        if PY3_OR_LATER:
-            super().shutdown()
-            super().server_close()
-        else:
-            super(ControllerHTTPServer, self).shutdown()
-            super(ControllerHTTPServer, self).server_close()
+        super(ControllerServer, self).shutdown()
+        super(ControllerServer, self).server_close()
 
     # http://preshing.com/20110920/the-python-with-statement-by-example/#implementing-the-context-manager-as-a-generator
     @contextmanager
@@ -450,39 +939,115 @@ class ControllerHTTPServer(HTTPServer, object):
         yield True
         self.frame_skip_enabled = True
 
+
+###############################################
+class ControllerHTTPServer(ControllerServer, HTTPServer):
+    """Controller server speaking HTTP, as mupen64plus-input-bot does.
+
+    With metrics_endpoint, a GET of /metrics is answered with the metrics
+    (in the Prometheus text format) instead of being treated as a frame.
+    """
+
+    def __init__(self, server_address, control_timeout, frame_skip, keep_alive=False, wire_format='json',
+                 metrics=None, metrics_endpoint=False):
+        handler_class = self.KeepAliveControllerRequestHandler if keep_alive \
+                        else self.ControllerRequestHandler
+        self.metrics_endpoint = metrics_endpoint
+        # Frames are handled one at a time, even when requests are handled on several threads
+        self.frame_lock = threading.Lock()
+        # (Explicit base calls; HTTPServer is an old-style class in Python 2)
+        ControllerServer.__init__(self, control_timeout, frame_skip, wire_format, metrics)
+        HTTPServer.__init__(self, server_address, handler_class)
+
     class ControllerRequestHandler(BaseHTTPRequestHandler, object):
 
         def log_message(self, fmt, *args):
             pass
 
-        def write_response(self, resp_code, resp_data):
+        def content_type(self):
+            return CONTENT_TYPES[self.server.wire_format]
+
+        def write_response(self, resp_code, resp_data, content_type=None):
             self.send_response(resp_code)
-            self.send_header("Content-type", "application/json")
+            self.send_header("Content-type", content_type or self.content_type())
             self.end_headers()
-            self.wfile.write(resp_data.encode())
+            self.wfile.write(resp_data)
 
         def do_GET(self):
-            # Wait for the controls to be updated before responding:
-            if self.server.running:
-                self.server.controls_updated.wait()
+            if self.server.metrics_endpoint and self.path == '/metrics':
+                self.write_response(200, self.server.metrics.to_prometheus().encode('utf-8'),
+                                    content_type=METRICS_CONTENT_TYPE)
+                return
 
+            with self.server.frame_lock:
+                if not self.server.wait_for_controls():
+                    print('Sending SHUTDOWN response')
+                    # TODO: This sometimes fails with a broken pipe because
+                    # the emulator has already stopped. Should handle gracefully (Issue #4)
+                    self.write_response(500, b"SHUTDOWN")
+                else:
+                    ### respond with controller output
+                    self.write_response(200, self.server.response_data)
+
+                self.server.controls_served()
+
+    class KeepAliveControllerRequestHandler(ControllerRequestHandler):
+        # HTTP/1.1 keeps the connection open between frames, so the emulator
+        # doesn't need to reconnect (and we don't need to accept) every frame.
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def write_response(self, resp_code, resp_data, content_type=None):
+            self.send_response(resp_code)
+            self.send_header("Content-type", content_type or self.content_type())
+            self.send_header("Content-Length", str(len(resp_data)))
             if not self.server.running:
-                print('Sending SHUTDOWN response')
-                # TODO: This sometimes fails with a broken pipe because
-                # the emulator has already stopped. Should handle gracefully (Issue #4)
-                self.write_response(500, "SHUTDOWN")
-            else:
-                ### respond with controller output
-                self.write_response(200, self.server.controls.to_json())
-
-            self.server.responses_sent += 1
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            self.wfile.write(resp_data)
 
-            # If we have sent the controls 'n' times now...
-            if self.server.responses_sent >= self.server.frame_skip or not self.server.frame_skip_enabled:
-                # ...we fire the response_sent event so the next action can happen:
-                self.server.controls_updated.clear()
-                self.server.response_sent.set()
 
+###############################################
+class ThreadingControllerHTTPServer(ThreadingMixIn, ControllerHTTPServer):
+    """ControllerHTTPServer handling each connection on its own thread, so a
+    request for /metrics isn't stuck behind the emulator's request waiting
+    for an action (or, with keep-alive, behind its connection).
+    """
+    daemon_threads = True
 
 
 ###############################################
+class ControllerTCPServer(ControllerServer, TCPServer):
+    """Controller server speaking a raw length-prefixed protocol over TCP.
+
+    The client sends a single POLL_REQUEST byte per frame over a persistent
+    connection. Each response is a RESPONSE_HEADER (status code and payload
+    length, mirroring the HTTP status codes) followed by the payload.
+    """
+
+    POLL_REQUEST = b'G'
+    RESPONSE_HEADER = struct.Struct('!HI')
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, control_timeout, frame_skip, wire_format='json', metrics=None):
+        ControllerServer.__init__(self, control_timeout, frame_skip, wire_format, metrics)
+        TCPServer.__init__(self, server_address, self.ControllerRequestHandler)
+
+    class ControllerRequestHandler(StreamRequestHandler, object):
+        disable_nagle_algorithm = True
+
+        def write_response(self, resp_code, resp_data):
+            self.wfile.write(ControllerTCPServer.RESPONSE_HEADER.pack(resp_code, len(resp_data)) + resp_data)
+            self.wfile.flush()
+
+        def handle(self):
+            while self.rfile.read(1) == ControllerTCPServer.POLL_REQUEST:
+                if not self.server.wait_for_controls():
+                    self.write_response(500, b"SHUTDOWN")
+                    self.server.controls_served()
+                    return
+
+                self.write_response(200, self.server.response_data)
+                self.server.controls_served()
@@ -0,0 +1,103 @@
+import numpy as np
+
+import cv2
+
+
+###############################################
+class ObservationBuffers(object):
+    """Preallocated arrays that observations are written into.
+
+    With a count of 0, a new array is allocated for every observation, so each
+    observation is safe to hold on to indefinitely. Otherwise `count` arrays
+    are allocated once and reused round-robin: an observation stays valid until
+    `count` more observations have been made (i.e. with a count of 2, the
+    previous step's observation is still intact alongside the current one).
+    Copy an observation to hold on to it any longer than that.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, count=0):
+        self.shape = shape
+        self.dtype = dtype
+        self.count = count
+        self._buffers = [np.empty(shape, dtype=dtype) for _ in range(count)]
+        self._index = 0
+
+    def acquire(self):
+        """Returns the array to write the next observation into."""
+        if self.count == 0:
+            return np.empty(self.shape, dtype=self.dtype)
+
+        buf = self._buffers[self._index]
+        self._index = (self._index + 1) % self.count
+        return buf
+
+
+###############################################
+class ObservationTransform(object):
+    """Crops, converts to grayscale, resizes and/or rescales the screen into
+    the observation handed to the agent.
+
+    The screen itself is left untouched, so reward and end-state detection can
+    keep reading the full-resolution pixels. Resizing uses area resampling,
+    which averages whole blocks of pixels when downscaling by integer factors.
+    """
+
+    DTYPES = ('uint8', 'float32')
+
+    def __init__(self, screen_shape, crop=None, width=None, height=None,
+                 grayscale=False, dtype='uint8', buffer_count=0):
+        screen_h, screen_w, screen_d = screen_shape
+
+        # crop is (x, y, width, height), within the screen
+        if crop is not None:
+            crop = tuple(int(v) for v in crop)
+            if crop[0] < 0 or crop[1] < 0 or crop[0] + crop[2] > screen_w or crop[1] + crop[3] > screen_h:
+                raise AssertionError('OBS_CROP %s is outside the %ix%i screen' % (crop, screen_w, screen_h))
+            screen_w, screen_h = crop[2], crop[3]
+        if dtype not in self.DTYPES:
+            raise AssertionError('OBS_DTYPE must be one of: %s' % ', '.join(self.DTYPES))
+
+        self.crop = crop
+        self.width = width or screen_w
+        self.height = height or screen_h
+        self.grayscale = grayscale
+        self.dtype = np.dtype(dtype)
+        self.resize = (self.width, self.height) != (screen_w, screen_h)
+        self.identity = crop is None and not self.resize and not grayscale and self.dtype == np.uint8
+
+        self.shape = (self.height, self.width, 1 if grayscale else screen_d)
+        self.high = 255 if self.dtype == np.uint8 else 1.0
+        self.buffers = ObservationBuffers(self.shape, dtype=self.dtype, count=buffer_count)
+
+        # Intermediate results, reused across calls:
+        self._gray = np.empty((screen_h, screen_w), dtype=np.uint8) if grayscale and self.resize else None
+        self._scaled = np.empty(self.shape, dtype=np.uint8) if self.dtype != np.uint8 else None
+
+    def apply(self, pixels):
+        """Returns the observation for the given (RGB) screen pixels."""
+        if self.identity:
+            return pixels
+
+        if self.crop is not None:
+            x, y, w, h = self.crop
+            pixels = pixels[y:y + h, x:x + w]
+
+        out = self.buffers.acquire()
+        target = self._scaled if self._scaled is not None else out
+        # OpenCV reads and writes single channel images as 2D arrays
+        if self.grayscale:
+            target = target.reshape(self.height, self.width)
+
+        if self.grayscale and self.resize:
+            cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY, dst=self._gray)
+            cv2.resize(self._gray, (self.width, self.height), dst=target, interpolation=cv2.INTER_AREA)
+        elif self.grayscale:
+            cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY, dst=target)
+        elif self.resize:
+            cv2.resize(pixels, (self.width, self.height), dst=target, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(target, pixels)
+
+        if self._scaled is not None:
+            np.multiply(self._scaled, 1.0 / 255, out=out, casting='same_kind')
+        return out
@@ -0,0 +1,262 @@
+import sys
+
+PY3_OR_LATER = sys.version_info[0] >= 3
+
+if PY3_OR_LATER:
+    # Python 3 specific definitions
+    from queue import Full, Queue
+else:
+    # Python 2 specific definitions
+    from Queue import Full, Queue
+
+import errno
+import json
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+
+
+# The files of a recorded episode (in its own directory):
+OBSERVATIONS_FILE = 'observations.bin'  # The compressed chunks of observations, back to back
+CHUNK_INDEX_FILE = 'chunk_index.npy'    # (offset, length, observation count) of each chunk
+STEPS_FILE = 'steps.npy'                # The step number of each recorded step
+ACTIONS_FILE = 'actions.npy'
+REWARDS_FILE = 'rewards.npy'
+DONES_FILE = 'dones.npy'
+METADATA_FILE = 'metadata.json'
+
+
+###############################################
+class TrajectoryRecorder(object):
+    """Records episodes of (observation, action, reward, done) to disk, for
+    offline RL, from a background thread.
+
+    record_reset() and record_step() copy the observation and queue it; the
+    writer thread does the encoding and writing. Each episode is written to
+    its own directory under `directory`: the observations are split into
+    chunks of `chunk_size`, each compressed with zlib after XORing every
+    observation with the one before it (consecutive observations barely
+    differ, so the deltas are mostly zeros). Each chunk starts from a whole
+    observation, so any chunk can be decoded on its own; see EpisodeReader.
+
+    The queue holds at most `queue_size` entries. When it is full, the step
+    loop waits for the writer (with block_when_full) or the step is dropped
+    (and missing from the episode's step numbers); either way it is counted
+    in `stats`.
+    """
+
+    def __init__(self, directory, chunk_size=256, queue_size=64, block_when_full=True,
+                 compression_level=1):
+        self.directory = os.path.expanduser(directory)
+        _make_directory(self.directory, parents=True)
+        self.chunk_size = chunk_size
+        self.block_when_full = block_when_full
+        self.compression_level = compression_level
+        # queued: entries handed to the writer, dropped: entries lost to a full queue,
+        # blocked: times (and blocked_seconds: total time) the step loop waited for the writer,
+        # max_queue_depth: the most entries waiting at once,
+        # written: observations written, bytes_written: their compressed size
+        self.stats = {'queued': 0, 'dropped': 0, 'blocked': 0, 'blocked_seconds': 0.0,
+                      'max_queue_depth': 0, 'written': 0, 'bytes_written': 0}
+        self._queue = Queue(maxsize=queue_size)
+        self._error = None
+        self._writer = threading.Thread(target=self._write_episodes)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def record_reset(self, observation):
+        """Starts a new episode from its first observation."""
+        # Always delivered, or the steps would be recorded to the previous episode
+        self._put(('reset', np.array(observation)), always_block=True)
+
+    def record_step(self, step, action, observation, reward, done):
+        self._put(('step', (step, np.array(action), np.array(observation), reward, done)))
+
+    def close(self):
+        """Writes out everything queued, and the current episode's index."""
+        self._put(None, always_block=True)
+        self._writer.join()
+
+    def _put(self, entry, always_block=False):
+        if self._error is not None:
+            raise self._error
+        try:
+            self._queue.put_nowait(entry)
+        except Full:
+            if not (self.block_when_full or always_block):
+                self.stats['dropped'] += 1
+                return
+            start = time.time()
+            self._queue.put(entry)
+            self.stats['blocked'] += 1
+            self.stats['blocked_seconds'] += time.time() - start
+        self.stats['queued'] += 1
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queue.qsize())
+
+    def _write_episodes(self):
+        episode = None
+        episode_number = 0
+        try:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    break
+                kind, value = entry
+                if kind == 'reset':
+                    if episode is not None:
+                        episode.close()
+                    # Numbered after any episodes already in the directory. Envs may share
+                    # the directory, so take the next number whose directory we create.
+                    episode_number += 1
+                    while not _make_directory(os.path.join(self.directory, 'episode_%06d' % episode_number)):
+                        episode_number += 1
+                    episode_dir = os.path.join(self.directory, 'episode_%06d' % episode_number)
+                    episode = _EpisodeWriter(episode_dir, value, self.chunk_size,
+                                             self.compression_level, self.stats)
+                elif episode is not None:
+                    episode.add_step(*value)
+            if episode is not None:
+                episode.close()
+        except Exception as e:
+            self._error = e
+            # Keep draining, so the step loop never blocks on a dead writer
+            while self._queue.get() is not None:
+                pass
+
+
+def _make_directory(path, parents=False):
+    # Creates the directory, returning False if it already exists (e.g. another env created it first)
+    try:
+        if parents:
+            os.makedirs(path)
+        else:
+            os.mkdir(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    return True
+
+
+class _EpisodeWriter(object):
+    # Writes one episode's observations chunk by chunk (into the existing
+    # directory), and its index on close()
+
+    def __init__(self, directory, first_observation, chunk_size, compression_level, stats):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.stats = stats
+        self.observation_shape = first_observation.shape
+        self.observation_dtype = first_observation.dtype
+        self._file = open(os.path.join(directory, OBSERVATIONS_FILE), 'wb')
+        self._chunk_index = []
+        # The chunk being written: each observation is compressed as it arrives
+        self._chunk_offset = 0
+        self._chunk_count = 0
+        self._compressor = None
+        self._previous = np.empty_like(first_observation)
+        self._delta = np.empty(first_observation.nbytes, dtype=np.uint8)
+        self._steps = []
+        self._actions = []
+        self._rewards = []
+        self._dones = []
+        self._add_observation(first_observation)
+
+    def add_step(self, step, action, observation, reward, done):
+        self._steps.append(step)
+        self._actions.append(action)
+        self._rewards.append(reward)
+        self._dones.append(done)
+        self._add_observation(observation)
+
+    def _add_observation(self, observation):
+        observation = observation.reshape(-1).view(np.uint8)
+        previous = self._previous.reshape(-1).view(np.uint8)
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.compression_level)
+            self._file.write(self._compressor.compress(observation))
+        else:
+            np.bitwise_xor(observation, previous, out=self._delta)
+            self._file.write(self._compressor.compress(self._delta))
+        np.copyto(previous, observation)
+        self._chunk_count += 1
+        if self._chunk_count == self.chunk_size:
+            self._end_chunk()
+
+    def _end_chunk(self):
+        self._file.write(self._compressor.flush())
+        offset = self._file.tell()
+        self._chunk_index.append((self._chunk_offset, offset - self._chunk_offset, self._chunk_count))
+        self.stats['written'] += self._chunk_count
+        self.stats['bytes_written'] += offset - self._chunk_offset
+        self._chunk_offset = offset
+        self._chunk_count = 0
+        self._compressor = None
+
+    def close(self):
+        if self._compressor is not None:
+            self._end_chunk()
+        self._file.close()
+        np.save(os.path.join(self.directory, CHUNK_INDEX_FILE),
+                np.array(self._chunk_index, dtype=np.int64).reshape(-1, 3))
+        np.save(os.path.join(self.directory, STEPS_FILE), np.array(self._steps, dtype=np.int64))
+        np.save(os.path.join(self.directory, ACTIONS_FILE), np.array(self._actions))
+        np.save(os.path.join(self.directory, REWARDS_FILE), np.array(self._rewards, dtype=np.float64))
+        np.save(os.path.join(self.directory, DONES_FILE), np.array(self._dones, dtype=bool))
+        with open(os.path.join(self.directory, METADATA_FILE), 'w') as f:
+            json.dump({'observation_shape': list(self.observation_shape),
+                       'observation_dtype': str(self.observation_dtype),
+                       'chunk_size': self.chunk_size,
+                       'steps': len(self._actions)}, f)
+
+
+###############################################
+class EpisodeReader(object):
+    """Reads an episode written by TrajectoryRecorder.
+
+    `steps` (the step numbers), `actions`, `rewards` and `dones` are
+    memory-mapped arrays with an entry per recorded step; there is one more
+    observation than recorded steps, the first being the one reset()
+    returned. observation(i) decodes just the chunk holding observation i
+    (the last chunk decoded is kept); chunk(i) returns all of chunk i's
+    observations as one array.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, METADATA_FILE)) as f:
+            metadata = json.load(f)
+        self.observation_shape = tuple(metadata['observation_shape'])
+        self.observation_dtype = np.dtype(metadata['observation_dtype'])
+        self.chunk_size = metadata['chunk_size']
+        self.chunk_index = np.load(os.path.join(directory, CHUNK_INDEX_FILE))
+        self.steps = np.load(os.path.join(directory, STEPS_FILE), mmap_mode='r')
+        self.actions = np.load(os.path.join(directory, ACTIONS_FILE), mmap_mode='r')
+        self.rewards = np.load(os.path.join(directory, REWARDS_FILE), mmap_mode='r')
+        self.dones = np.load(os.path.join(directory, DONES_FILE), mmap_mode='r')
+        self._observations = np.memmap(os.path.join(directory, OBSERVATIONS_FILE), dtype=np.uint8, mode='r') \
+                             if len(self.chunk_index) else None
+        self._cached_chunk = (None, None)
+
+    def __len__(self):
+        # The number of observations
+        return int(self.chunk_index[:, 2].sum())
+
+    def chunk(self, index):
+        if self._cached_chunk[0] == index:
+            return self._cached_chunk[1]
+        offset, length, count = self.chunk_index[index]
+        data = zlib.decompress(self._observations[offset:offset + length].tobytes())
+        deltas = np.frombuffer(data, dtype=np.uint8).reshape((count, -1))
+        # Undo the XOR with the previous observation
+        observations = np.bitwise_xor.accumulate(deltas, axis=0)
+        observations = observations.view(self.observation_dtype).reshape((count,) + self.observation_shape)
+        self._cached_chunk = (index, observations)
+        return observations
+
+    def observation(self, index):
+        return self.chunk(index // self.chunk_size)[index % self.chunk_size]
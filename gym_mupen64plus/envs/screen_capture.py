@@ -0,0 +1,143 @@
+import mmap
+import struct
+import threading
+import time
+
+import numpy as np
+
+import mss
+
+
+# The supported values of the CAPTURE_BACKEND config:
+CAPTURE_BACKENDS = ('mss', 'framebuffer')
+
+# The name of the file Xvfb keeps screen 0 in (in the -fbdir directory):
+XVFB_SCREEN_FILE = 'Xvfb_screen0'
+
+
+###############################################
+class MssCapture(object):
+    """Grabs the screen through the X server with mss.
+
+    grab() returns a view of a new screenshot each call.
+    """
+
+    def __init__(self, display=None):
+        self._mss = mss.mss(display=display)
+
+    def grab(self, left, top, width, height):
+        screenshot = self._mss.grab({"top": top,
+                                     "left": left,
+                                     "width": width,
+                                     "height": height})
+        # View the screenshot's raw BGRA bytes rather than copying them
+        return np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(height, width, 4)
+
+
+###############################################
+class XvfbFramebufferCapture(object):
+    """Reads the screen straight out of the framebuffer file Xvfb maintains
+    when started with `-fbdir`.
+
+    The file is an XWD image which Xvfb renders into directly, so mapping it
+    gives a live view of the screen without going through the X protocol.
+    grab() returns a view of the live framebuffer; copy it to hold on to it.
+    """
+
+    # XWD file header: 25 big-endian CARD32 values, followed by the window name
+    # (included in header_size) and then ncolors 12-byte colormap entries
+    XWD_HEADER = struct.Struct('!25I')
+    XWD_COLOR_SIZE = 12
+
+    # Indices of the XWD_HEADER values we need
+    HEADER_SIZE = 0
+    PIXMAP_WIDTH = 4
+    PIXMAP_HEIGHT = 5
+    BYTE_ORDER = 7
+    BITS_PER_PIXEL = 11
+    BYTES_PER_LINE = 12
+    NCOLORS = 19
+
+    LSB_FIRST = 0
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+        self._screen = None
+
+    def _map_framebuffer(self):
+        with open(self.path, 'rb') as fb_file:
+            self._mmap = mmap.mmap(fb_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = self.XWD_HEADER.unpack_from(self._mmap, 0)
+        # Pixels are stored in the X server's byte order; we expect BGRA like mss
+        if header[self.BITS_PER_PIXEL] != 32 or header[self.BYTE_ORDER] != self.LSB_FIRST:
+            raise Exception('Unsupported framebuffer format (%i bits per pixel, byte order %i) in %s' %
+                            (header[self.BITS_PER_PIXEL], header[self.BYTE_ORDER], self.path))
+
+        width = header[self.PIXMAP_WIDTH]
+        height = header[self.PIXMAP_HEIGHT]
+        bytes_per_line = header[self.BYTES_PER_LINE]
+        offset = header[self.HEADER_SIZE] + header[self.NCOLORS] * self.XWD_COLOR_SIZE
+
+        pixels = np.frombuffer(self._mmap, dtype=np.uint8,
+                               count=bytes_per_line * height, offset=offset)
+        self._screen = pixels.reshape(height, bytes_per_line // 4, 4)[:, :width]
+
+    def grab(self, left, top, width, height):
+        # Xvfb creates the file on startup, so map it on first use
+        if self._screen is None:
+            self._map_framebuffer()
+        return self._screen[top:top + height, left:left + width]
+
+
+###############################################
+class SharedScreenCapture(object):
+    """Captures a screen shared by several envs, each in its own region, with
+    one grab of the whole screen per step rather than one grab per env.
+
+    Each env calls grab() for its own region from its own thread (as with
+    VectorMupenEnv). The callers wait for each other, up to sync_timeout
+    seconds; then a single grab of the whole screen serves all of them. A
+    caller is always served a grab taken after it called grab(), so an env
+    observing on its own (e.g. on reset) just grabs once the timeout expires.
+
+    Every call counts as one of the `parties`, so only the once-per-step
+    observation should grab through it. The frames captured for
+    FRAME_SKIP_POOLING (on each env's controller server thread) are played at
+    different times in each env; counted as parties they would release the
+    callers early with a mix of steps' frames, so envs capture those with their
+    own capture (Mupen64PlusEnv.skipped_frame_capture) instead.
+    """
+
+    def __init__(self, capture, width, height, parties, sync_timeout=0.1):
+        self.capture = capture
+        self.width = width
+        self.height = height
+        self.parties = parties
+        self.sync_timeout = sync_timeout
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._generation = 0
+        self._screen = None
+
+    def grab(self, left, top, width, height):
+        with self._condition:
+            generation = self._generation
+            self._waiting += 1
+
+            deadline = time.time() + self.sync_timeout
+            while self._generation == generation and self._waiting < self.parties:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            # Everyone's here (or we're done waiting): grab for all the waiting callers
+            if self._generation == generation:
+                self._screen = self.capture.grab(0, 0, self.width, self.height)
+                self._generation += 1
+                self._waiting = 0
+                self._condition.notify_all()
+
+            return self._screen[top:top + height, left:left + width]
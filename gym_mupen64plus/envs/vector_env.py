@@ -0,0 +1,392 @@
+import sys
+
+PY3_OR_LATER = sys.version_info[0] >= 3
+
+if PY3_OR_LATER:
+    # Python 3 specific definitions
+    from queue import Queue
+else:
+    # Python 2 specific definitions
+    from Queue import Queue
+
+import functools
+import inspect
+import multiprocessing
+import os
+import tempfile
+import threading
+import traceback
+
+import gym
+from gym.envs.registration import load
+from gym.wrappers.time_limit import TimeLimit
+
+import numpy as np
+
+import yaml
+
+from gym_mupen64plus.envs.screen_capture import MssCapture, SharedScreenCapture
+from gym_mupen64plus.envs.xvfb import TiledXvfb
+
+
+###############################################
+class EnvWorker(threading.Thread):
+    """Thread which runs the calls submitted to it, one at a time."""
+
+    def __init__(self):
+        super(EnvWorker, self).__init__()
+        self.daemon = True
+        self._calls = Queue()
+        self._results = Queue()
+        self.start()
+
+    def submit(self, fn, *args):
+        self._calls.put((fn, args))
+
+    def result(self):
+        # Returns the result of the oldest outstanding call, re-raising its exception (if any)
+        succeeded, value = self._results.get()
+        if not succeeded:
+            raise value
+        return value
+
+    def stop(self):
+        self._calls.put((None, None))
+
+    def run(self):
+        while True:
+            fn, args = self._calls.get()
+            if fn is None:
+                return
+            try:
+                self._results.put((True, fn(*args)))
+            except Exception as e:
+                self._results.put((False, e))
+
+
+###############################################
+class VectorMupenEnv(object):
+    """Drives several Mupen64PlusEnv instances from one process.
+
+    Each env is owned by its own worker thread, so the envs are constructed,
+    reset and stepped concurrently; the emulators run in their own processes
+    and an env spends most of a step waiting on its emulator. Observations,
+    rewards and done flags are returned stacked into NumPy arrays.
+
+    An env whose episode ends is reset automatically at the end of the step;
+    the observation returned for it is the first one of the new episode, and
+    the final observation of the old one is in its info as
+    'terminal_observation'.
+
+    If the envs' emulators share one TiledXvfb screen (passed as
+    shared_screen, which is then closed along with the envs) and capture it
+    with mss, they also share a single grab of the screen per step.
+    """
+
+    def __init__(self, env_fns, shared_screen=None):
+        self.num_envs = len(env_fns)
+        self.shared_screen = shared_screen
+        self._workers = [EnvWorker() for _ in env_fns]
+        self.envs = self._construct_envs(env_fns)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+
+        if shared_screen is not None and isinstance(self.envs[0].unwrapped.screen_capture, MssCapture):
+            screen_capture = SharedScreenCapture(MssCapture(shared_screen.display),
+                                                 shared_screen.width, shared_screen.height,
+                                                 parties=self.num_envs)
+            # Only the observations share the grab; each env still captures the
+            # frames it pools (FRAME_SKIP_POOLING) itself, see SharedScreenCapture
+            for env in self.envs:
+                env.unwrapped.screen_capture = screen_capture
+
+    def reset(self):
+        return np.stack(self._run_all([(env.reset,) for env in self.envs]))
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        """Starts stepping each env with its action and returns immediately;
+        call step_wait() to get the results.
+        """
+        self._submit_all([(self._step_env, env, action)
+                          for env, action in zip(self.envs, actions)])
+
+    def step_wait(self):
+        obs, rewards, dones, infos = zip(*self._collect_all())
+        return np.stack(obs), np.array(rewards), np.array(dones), list(infos)
+
+    def close(self):
+        self._run_all([(env.close,) for env in self.envs])
+        for worker in self._workers:
+            worker.stop()
+        if self.shared_screen is not None:
+            self.shared_screen.close()
+
+    def _construct_envs(self, env_fns):
+        # If any env fails to construct, the ones that didn't (and their
+        # emulators) are closed, and the workers stopped, before re-raising
+        self._submit_all([(env_fn,) for env_fn in env_fns])
+        envs = []
+        error = None
+        for worker in self._workers:
+            try:
+                envs.append(worker.result())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            for env in envs:
+                try:
+                    env.close()
+                except Exception:
+                    traceback.print_exc()
+            for worker in self._workers:
+                worker.stop()
+            raise error
+        return envs
+
+    @staticmethod
+    def _step_env(env, action):
+        obs, reward, done, info = env.step(action)
+        if done:
+            # Copied, in case the reset reuses the observation buffer
+            info = dict(info, terminal_observation=np.array(obs))
+            obs = env.reset()
+        return obs, reward, done, info
+
+    def _run_all(self, calls):
+        # Runs each (fn, *args) call on the corresponding worker and
+        # returns the results in order, once all of them have finished
+        self._submit_all(calls)
+        return self._collect_all()
+
+    def _submit_all(self, calls):
+        for worker, call in zip(self._workers, calls):
+            worker.submit(*call)
+
+    def _collect_all(self):
+        results = []
+        error = None
+        for worker in self._workers:
+            try:
+                results.append(worker.result())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+
+###############################################
+class SubprocVectorMupenEnv(object):
+    """Drives several Mupen64PlusEnv instances, each in its own worker process.
+
+    Unlike VectorMupenEnv, the envs' Python code (controller server, screen
+    capture, reward detection) runs in separate processes, so stepping scales
+    across cores rather than contending for one interpreter.
+
+    Observations are not sent back through the pipes: each worker writes its
+    observation straight into its row of an array shared by all the
+    processes (a memory-mapped file, in /dev/shm where available), and only
+    the rewards, done flags and infos are pickled. reset() and step() return
+    a copy of the shared array, or with copy_observations=False the shared
+    array itself, which is then overwritten by the next reset() or step().
+
+    Ended episodes are reset automatically, as in VectorMupenEnv. env_fns
+    must be picklable if the multiprocessing start method isn't 'fork'.
+    A shared_screen (TiledXvfb) is closed along with the envs.
+    """
+
+    def __init__(self, env_fns, copy_observations=True, shared_screen=None):
+        self.num_envs = len(env_fns)
+        self.copy_observations = copy_observations
+        self.shared_screen = shared_screen
+        self._pipes = []
+        self._processes = []
+        for env_fn in env_fns:
+            parent_pipe, child_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_subproc_worker,
+                                              args=(child_pipe, parent_pipe, env_fn))
+            process.daemon = True
+            process.start()
+            child_pipe.close()
+            self._pipes.append(parent_pipe)
+            self._processes.append(process)
+
+        try:
+            # The workers construct their envs concurrently, then report back
+            self.observation_space, self.action_space, obs_dtype = self._receive_all()[0]
+
+            shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            fd, path = tempfile.mkstemp(prefix='gym-mupen64plus-', suffix='.obs', dir=shm_dir)
+            os.close(fd)
+            try:
+                shape = (self.num_envs,) + self.observation_space.shape
+                self._observations = np.memmap(path, dtype=obs_dtype, mode='w+', shape=shape)
+                self._send_all([('attach', (path, obs_dtype, shape, index))
+                                for index in range(self.num_envs)])
+                self._receive_all()
+            finally:
+                # Every process has it mapped by now; the memory lives until they all unmap it
+                os.remove(path)
+        except Exception:
+            # Close the envs that were constructed (a failed worker has already exited)
+            self._close_workers()
+            raise
+
+    def reset(self):
+        self._send_all([('reset', None)] * self.num_envs)
+        self._receive_all()
+        return self._get_observations()
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        """Sends each worker its action and returns immediately; call
+        step_wait() to get the results.
+        """
+        self._send_all([('step', action) for action in actions])
+
+    def step_wait(self):
+        rewards, dones, infos = zip(*self._receive_all())
+        return self._get_observations(), np.array(rewards), np.array(dones), list(infos)
+
+    def close(self):
+        self._close_workers()
+        if self.shared_screen is not None:
+            self.shared_screen.close()
+
+    def _close_workers(self):
+        for pipe in self._pipes:
+            try:
+                pipe.send(('close', None))
+            except IOError:
+                pass # The worker has already exited
+        for pipe, process in zip(self._pipes, self._processes):
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+            pipe.close()
+
+    def _get_observations(self):
+        if self.copy_observations:
+            return np.array(self._observations)
+        return self._observations
+
+    def _send_all(self, commands):
+        for pipe, command in zip(self._pipes, commands):
+            pipe.send(command)
+
+    def _receive_all(self):
+        # Waits for a reply from every worker, raising the first error (if any)
+        results = []
+        error = None
+        for pipe in self._pipes:
+            try:
+                succeeded, value = pipe.recv()
+            except EOFError:
+                succeeded, value = False, 'Env worker process exited unexpectedly'
+            if succeeded:
+                results.append(value)
+            elif error is None:
+                error = value
+        if error is not None:
+            raise Exception(error)
+        return results
+
+
+def _subproc_worker(pipe, parent_pipe, env_fn):
+    # Runs in the worker process: owns one env and serves the parent's commands
+    parent_pipe.close()
+    env = None
+    try:
+        env = env_fn()
+        pipe.send((True, (env.observation_space, env.action_space,
+                          env.unwrapped.observation_transform.dtype)))
+        observation = None
+        while True:
+            command, args = pipe.recv()
+            result = None
+            if command == 'attach':
+                path, obs_dtype, shape, index = args
+                observation = np.memmap(path, dtype=obs_dtype, mode='r+', shape=shape)[index]
+            elif command == 'reset':
+                observation[...] = env.reset()
+            elif command == 'step':
+                obs, reward, done, info = VectorMupenEnv._step_env(env, args)
+                observation[...] = obs
+                result = (reward, done, info)
+            elif command == 'close':
+                env.close()
+                env = None
+                pipe.send((True, None))
+                return
+            pipe.send((True, result))
+    except Exception:
+        pipe.send((False, traceback.format_exc()))
+    finally:
+        if env is not None:
+            env.close()
+        pipe.close()
+
+
+def _make_env(spec, config_overrides):
+    env = load(spec._entry_point)(config_overrides=config_overrides, **spec._kwargs)
+    env.spec = spec
+    if spec.timestep_limit is not None:
+        env = TimeLimit(env,
+                        max_episode_steps=spec.max_episode_steps,
+                        max_episode_seconds=spec.max_episode_seconds)
+    return env
+
+
+def make_vector_env(env_id, num_envs, config_overrides=None, use_processes=False, tile_screen=False):
+    """Creates a vector env running num_envs instances of a registered env:
+    a SubprocVectorMupenEnv if use_processes, otherwise a VectorMupenEnv.
+
+    Each instance gets its own controller server port (PORT_NUMBER 0) and is
+    wrapped in a TimeLimit as gym.make() would. With tile_screen, the
+    emulators share one Xvfb screen (a TiledXvfb), each in its own tile,
+    instead of starting an Xvfb each.
+    """
+    overrides = dict(config_overrides or {}, PORT_NUMBER=0)
+    env_overrides = [overrides] * num_envs
+
+    shared_screen = None
+    if tile_screen:
+        config = _load_base_config(overrides)
+        shared_screen = TiledXvfb(num_envs, config['SCREEN_WIDTH'], config['SCREEN_HEIGHT'],
+                                  xvfb_cmd=config['XVFB_CMD'],
+                                  tmp_dir=config['TMP_DIR'],
+                                  timeout=config['STARTUP_TIMEOUT'])
+        env_overrides = []
+        for index in range(num_envs):
+            offset_x, offset_y = shared_screen.tile_offset(index)
+            tile_overrides = dict(overrides, XVFB_DISPLAY=shared_screen.display,
+                                  OFFSET_X=offset_x, OFFSET_Y=offset_y)
+            if config['CAPTURE_BACKEND'] == 'framebuffer':
+                tile_overrides['FRAMEBUFFER_PATH'] = shared_screen.framebuffer_path
+            env_overrides.append(tile_overrides)
+
+    spec = gym.spec(env_id)
+    env_fns = [functools.partial(_make_env, spec, env_overrides[index]) for index in range(num_envs)]
+
+    try:
+        if use_processes:
+            return SubprocVectorMupenEnv(env_fns, shared_screen=shared_screen)
+        return VectorMupenEnv(env_fns, shared_screen=shared_screen)
+    except Exception:
+        if shared_screen is not None:
+            shared_screen.close()
+        raise
+
+
+def _load_base_config(config_overrides):
+    # The base env config, without any game specific settings
+    config = yaml.safe_load(open(os.path.join(os.path.dirname(inspect.stack()[0][1]), "config.yml")))
+    config.update(config_overrides)
+    return config
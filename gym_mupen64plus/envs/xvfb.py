@@ -0,0 +1,103 @@
+import sys
+
+PY3_OR_LATER = sys.version_info[0] >= 3
+
+import math
+import os
+import select
+import shutil
+import subprocess
+import tempfile
+import time
+from termcolor import cprint
+
+from gym_mupen64plus.envs.screen_capture import XVFB_SCREEN_FILE
+
+
+def start_xvfb(xvfb_cmd, width, height, depth, fb_dir, timeout):
+    """Starts an Xvfb server with a single width x height x depth screen,
+    kept in a framebuffer file in fb_dir.
+
+    Returns the Xvfb process and its display number once it is ready to
+    accept connections. With -displayfd, Xvfb picks a free display number
+    itself and writes it to the given file descriptor when it is ready, so
+    there's no need to probe display numbers or wait a fixed amount of time.
+    """
+    read_fd, write_fd = os.pipe()
+    cmd = [xvfb_cmd,
+           "-displayfd",
+           str(write_fd),
+           "-screen",
+           "0",
+           "%ix%ix%i" % (width, height, depth),
+           "-fbdir",
+           fb_dir]
+
+    cprint('Starting xvfb with command: %s' % cmd, 'yellow')
+
+    try:
+        if PY3_OR_LATER:
+            xvfb_proc = subprocess.Popen(cmd, shell=False, stderr=subprocess.STDOUT,
+                                         pass_fds=(write_fd,))
+        else:
+            # (Python 2 child processes inherit the pipe by default)
+            xvfb_proc = subprocess.Popen(cmd, shell=False, stderr=subprocess.STDOUT)
+        os.close(write_fd)
+        write_fd = None
+        display_num = _read_display_number(read_fd, xvfb_proc, timeout)
+    finally:
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+
+    return xvfb_proc, display_num
+
+
+def _read_display_number(read_fd, xvfb_proc, timeout):
+    deadline = time.time() + timeout
+    output = b''
+    while not output.endswith(b'\n'):
+        remaining = deadline - time.time()
+        readable = select.select([read_fd], [], [], max(remaining, 0))[0]
+        data = os.read(read_fd, 16) if readable else None
+        if not data:
+            # Timed out, or Xvfb exited (closing the pipe) before reporting its display
+            xvfb_proc.kill()
+            xvfb_proc.wait()
+            msg = "Failed to initialize Xvfb!"
+            cprint(msg, 'red')
+            raise Exception(msg)
+        output += data
+    return int(output)
+
+
+###############################################
+class TiledXvfb(object):
+    """An Xvfb server whose screen is divided into a grid of tiles, each
+    holding one emulator window, so several envs can share one X server.
+    """
+
+    def __init__(self, num_tiles, tile_width, tile_height, xvfb_cmd='Xvfb',
+                 tmp_dir=None, timeout=30, columns=None):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.columns = columns or int(math.ceil(math.sqrt(num_tiles)))
+        self.rows = int(math.ceil(num_tiles / float(self.columns)))
+        self.width = self.columns * tile_width
+        self.height = self.rows * tile_height
+
+        self.fb_dir = tempfile.mkdtemp(prefix='gym-mupen64plus-', dir=tmp_dir)
+        self.framebuffer_path = os.path.join(self.fb_dir, XVFB_SCREEN_FILE)
+        self.process, display_num = start_xvfb(xvfb_cmd, self.width, self.height, 24,
+                                               self.fb_dir, timeout)
+        self.display = ":" + str(display_num)
+
+    def tile_offset(self, index):
+        """Returns the (x, y) of the top-left corner of the index'th tile."""
+        return ((index % self.columns) * self.tile_width,
+                (index // self.columns) * self.tile_height)
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.fb_dir, ignore_errors=True)
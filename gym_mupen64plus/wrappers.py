@@ -0,0 +1,93 @@
+import gym
+from gym import spaces
+from gym.wrappers.time_limit import TimeLimit
+
+import numpy as np
+
+
+###############################################
+class FrameStack(gym.Wrapper):
+    """Observes the last k observations of the wrapped env, stacked along a
+    new first axis (oldest first), i.e. with shape (k,) + the env's shape.
+
+    The observations are kept in one preallocated buffer with room for more
+    than k of them, and each stacked observation is a view of k consecutive
+    entries in it. A step writes just the newest observation into the buffer;
+    only when the end of the buffer is reached are the last k - 1 moved back
+    to its start. A stacked observation stays intact for at least
+    `history - 2k + 1` more steps, so copy it to hold on to it any longer.
+    """
+
+    def __init__(self, env, k=4, history=None):
+        super(FrameStack, self).__init__(env)
+        self.k = k
+        self.history = history or 4 * k
+        if self.history < 2 * k - 1:
+            raise AssertionError('FrameStack history must be at least 2k - 1')
+
+        space = env.observation_space
+        self.observation_space = spaces.Box(low=np.stack([space.low] * k),
+                                            high=np.stack([space.high] * k))
+        self._buffer = None
+        self._next = 0
+
+    def _reset(self):
+        obs = self.env.reset()
+        if self._buffer is None:
+            self._buffer = np.empty((self.history,) + obs.shape, dtype=obs.dtype)
+
+        # Start the stack with k copies of the first observation
+        self._buffer[:self.k] = obs
+        self._next = self.k
+        return self._buffer[:self.k]
+
+    def _step(self, action):
+        obs, reward, done, info = self.env.step(action)
+
+        if self._next == self.history:
+            self._buffer[:self.k - 1] = self._buffer[self.history - self.k + 1:]
+            self._next = self.k - 1
+        self._buffer[self._next] = obs
+        self._next += 1
+        return self._buffer[self._next - self.k:self._next], reward, done, info
+
+
+###############################################
+class SplitStepTimeLimit(TimeLimit):
+    """A TimeLimit which also offers the env's step_async() and step_wait(),
+    applying the time limit to steps taken either way.
+
+    gym.make() wraps envs in a plain TimeLimit, and gym's wrappers don't
+    forward methods they don't define, so step_async() isn't reachable
+    through it (and going through env.unwrapped skips the time limit).
+    Wrapping gym.make()'s env in this replaces its TimeLimit, keeping the
+    limits:
+
+        env = SplitStepTimeLimit(gym.make('Mario-Kart-Luigi-Raceway-v0'))
+        env.reset()
+        env.step_async(action)
+        obs, reward, done, info = env.step_wait()
+    """
+
+    def __init__(self, env, max_episode_seconds=None, max_episode_steps=None):
+        if isinstance(env, TimeLimit):
+            max_episode_seconds = env._max_episode_seconds
+            max_episode_steps = env._max_episode_steps
+            env = env.env
+        super(SplitStepTimeLimit, self).__init__(env, max_episode_seconds=max_episode_seconds,
+                                                 max_episode_steps=max_episode_steps)
+
+    def step_async(self, action):
+        assert self._episode_started_at is not None, "Cannot call env.step_async() before calling reset()"
+        self.env.step_async(action)
+
+    def step_wait(self):
+        observation, reward, done, info = self.env.step_wait()
+        self._elapsed_steps += 1
+
+        if self._past_limit():
+            if self.metadata.get('semantics.autoreset'):
+                _ = self.reset() # automatically reset the env
+            done = True
+
+        return observation, reward, done, info